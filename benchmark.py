@@ -1,7 +1,10 @@
 #!/usr/bin/python3
 
+import sys
+import subprocess
 import tempfile
 import cProfile
+import time
 
 (fileno, filename) = tempfile.mkstemp()
 
@@ -14,3 +17,93 @@ cProfile.run('run()', filename)
 import pstats
 p = pstats.Stats(filename)
 p.sort_stats('cumulative').print_stats(20)
+
+
+# Cold import time, each in a fresh interpreter:
+IMPORT_SCRIPT = """
+import time
+start = time.monotonic()
+{}
+print(time.monotonic() - start)
+"""
+
+
+def bench_import(label, statement, runs=5):
+    script = IMPORT_SCRIPT.format(statement)
+    times = sorted(
+        float(subprocess.check_output([sys.executable, '-c', script]))
+        for i in range(runs)
+    )
+    print('{:>8.1f} ms: {}'.format(times[runs // 2] * 1000, label))
+
+
+print('\nImport time (median of 5 cold starts):')
+bench_import('import userwebkit', 'import userwebkit')
+bench_import('import userwebkit; userwebkit.init()',
+    'import userwebkit; userwebkit.init()'
+)
+bench_import('from userwebkit.view import CouchView',
+    'from userwebkit.view import CouchView'
+)
+
+
+# Microbenchmark CouchView._on_request() using the unit test fixtures:
+import userwebkit
+from userwebkit.view import CouchView
+from userwebkit.tests import random_env, DummyMessage, DummyRequest
+
+N = 20000
+
+
+def bench_on_request(label, env, uris):
+    view = CouchView(env)
+    requests = [
+        DummyRequest(uris[i % len(uris)], DummyMessage())
+        for i in range(N)
+    ]
+    start = time.monotonic()
+    for request in requests:
+        view._on_request(None, None, None, request, None)
+    elapsed = time.monotonic() - start
+    print('{:>8,.0f} requests/second: {}'.format(N / elapsed, label))
+
+
+env = random_env()
+url = env['url']
+attachments = [url + 'db/doc{}/thumbnail'.format(i) for i in range(200)]
+other = [
+    'file:///usr/share/couchdb/apps/userwebkit/base.css',
+    'data:image/png;base64,AAAA',
+    'http://www.ubuntu.com/',
+]
+
+print('\nCouchView._on_request():')
+bench_on_request('other URIs', env, other)
+bench_on_request('OAuth', env, attachments)
+del env['oauth']
+bench_on_request('basic auth', env, attachments)
+
+
+# Microbenchmark Hub.send(), unbatched versus batched:
+from userwebkit.tests import DummyCouchView
+
+
+def bench_hub_send(label, batch, per_iteration):
+    view = DummyCouchView()
+    hub = userwebkit.Hub(view, batch)
+    start = time.monotonic()
+    for i in range(N):
+        hub.send('timer', i)
+        if batch and i % per_iteration == 0:
+            hub.flush()
+    hub.flush()
+    elapsed = time.monotonic() - start
+    print('{:>8,.0f} messages/second, {:>6,} scripts: {}'.format(
+        N / elapsed, len(view._scripts), label)
+    )
+
+
+print('\nHub.send():')
+bench_hub_send('unbatched', False, 1)
+bench_hub_send('batched, 10 per iteration', True, 10)
+bench_hub_send('batched, 100 per iteration', True, 100)
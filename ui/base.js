@@ -246,11 +246,21 @@ var Hub = {
     >>> Hub.send('click');
     >>> Hub.send('changed', 'foo', 'bar');
 
+    Messages sent to Gtk are queued and delivered in batches, and are re-sent
+    until Gtk acknowledges them by calling Hub.ack(), so none are lost when
+    Hub.send() is called faster than Gtk notices title changes.  Messages
+    larger than Hub.chunk_size are split into chunks, and no more than about
+    Hub.chunk_size is put into document.title until Gtk has acknowledged it.
+
     Or from the Gtk side, send a signal to JavaScript by using
     WebView.execute_script() to call Hub.recv() like this:
 
     >>> Hub.recv('{"signal": "error", "args": ["oops!"]}');
 
+    When the Gtk side batches messages, it calls Hub.recv_batch() instead:
+
+    >>> Hub.recv_batch('[{"signal": "error", "args": ["oops!"]}]');
+
     Use userwebkit.BaseApp.send() as a shortcut to do the above.
 
     Lastly, to emit a signal from JavaScript to JavaScript handlers, use
@@ -261,6 +271,18 @@ var Hub = {
     */
     i: 0,
 
+    session: Date.now().toString(36) + Math.random().toString(36).slice(2),
+
+    outbox: [],
+
+    flushes: 0,
+
+    chunk_size: 65536,
+
+    chunks: {},
+
+    timeout_id: null,
+
     names: {},
 
     connect: function(signal, callback, self) {
@@ -291,13 +313,112 @@ var Hub = {
         var signal = params[0];
         var args = params.slice(1);
         Hub._emit(signal, args);
-        var obj = {
-            'i': Hub.i,
-            'signal': signal,
-            'args': args,
-        };
+        var data = JSON.stringify({'signal': signal, 'args': args});
+        if (data.length <= Hub.chunk_size) {
+            Hub._push({'signal': signal, 'args': args});
+        }
+        else {
+            var start = 0;
+            while (start < data.length) {
+                var end = Hub._chunk_end(data, start);
+                // Chunk entries are only serialized when flushed:
+                Hub.outbox.push({
+                    'i': Hub.i, 'source': data, 'start': start, 'end': end,
+                });
+                Hub.i += 1;
+                start = end;
+            }
+        }
+        if (Hub.timeout_id == null) {
+            Hub.timeout_id = setTimeout(Hub._flush, 0);
+        }
+    },
+
+    _push: function(obj) {
+        /*
+        Low-level private function to add a message to the outbox.
+        */
+        obj.i = Hub.i;
         Hub.i += 1;
-        document.title = JSON.stringify(obj);
+        Hub.outbox.push({'i': obj.i, 'data': JSON.stringify(obj)});
+    },
+
+    _chunk_end: function(data, start) {
+        /*
+        Low-level private function to find where the chunk at *start* ends.
+
+        A chunk never ends between the two halves of a surrogate pair.
+        */
+        var end = Math.min(start + Hub.chunk_size, data.length);
+        if (end < data.length) {
+            var code = data.charCodeAt(end - 1);
+            if (code >= 0xD800 && code <= 0xDBFF) {
+                end -= 1;
+            }
+        }
+        return end;
+    },
+
+    _data: function(entry) {
+        /*
+        Low-level private function to get the JSON for an outbox entry.
+        */
+        if (entry.data == null) {
+            return JSON.stringify({
+                'chunk': entry.source.slice(entry.start, entry.end),
+                'more': entry.end < entry.source.length,
+                'i': entry.i,
+            });
+        }
+        return entry.data;
+    },
+
+    ack: function(i) {
+        /*
+        Gtk calls this to acknowledge all messages up to and including *i*.
+        */
+        while (Hub.outbox.length > 0 && Hub.outbox[0].i <= i) {
+            Hub.outbox.shift();
+        }
+        if (Hub.timeout_id != null) {
+            clearTimeout(Hub.timeout_id);
+            Hub.timeout_id = null;
+        }
+        if (Hub.outbox.length > 0) {
+            // More chunks are waiting on this acknowledgement:
+            Hub.timeout_id = setTimeout(Hub._flush, 0);
+        }
+    },
+
+    _flush: function() {
+        /*
+        Low-level private function to send unacknowledged messages.
+
+        At most about Hub.chunk_size worth of messages are sent at once.  If
+        they still aren't acknowledged after a while, they're sent again.
+        */
+        Hub.timeout_id = null;
+        if (Hub.outbox.length == 0) {
+            return;
+        }
+        Hub.flushes += 1;
+        var batch = [];
+        var size = 0;
+        Hub.outbox.every(function(entry) {
+            var data = Hub._data(entry);
+            if (batch.length > 0 && size + data.length > Hub.chunk_size) {
+                return false;
+            }
+            batch.push(data);
+            size += data.length;
+            return true;
+        });
+        Hub.timeout_id = setTimeout(Hub._flush, 500);
+        document.title = [
+            '{"session": ', JSON.stringify(Hub.session),
+            ', "flush": ', Hub.flushes,
+            ', "batch": [', batch.join(', '), ']}',
+        ].join('');
     },
 
     recv: function(data) {
@@ -315,6 +436,38 @@ var Hub = {
         Hub._emit(obj.signal, obj.args);
     },
 
+    recv_batch: function(data) {
+        /*
+        Gtk calls this function to emit several signals, in order.
+
+        For example:
+
+        >>> Hub.recv_batch('[{"signal": "timer", "args": [1]}, {"signal": "timer", "args": [2]}]');
+
+        */
+        JSON.parse(data).forEach(function(obj) {
+            Hub._emit(obj.signal, obj.args);
+        });
+    },
+
+    recv_chunk: function(id, chunk, more) {
+        /*
+        Gtk calls this function to deliver a large message in chunks.
+
+        Once the last chunk of transfer *id* arrives, the reassembled message
+        is passed to Hub.recv().
+        */
+        if (! Hub.chunks[id]) {
+            Hub.chunks[id] = [];
+        }
+        Hub.chunks[id].push(chunk);
+        if (! more) {
+            var data = Hub.chunks[id].join('');
+            delete Hub.chunks[id];
+            Hub.recv(data);
+        }
+    },
+
     emit: function() {
         /*
         Emit a signal from JavaScript to JavaScript handlers.
@@ -63,6 +63,30 @@ var couch = {
     random_id2: function() {
         return [Math.floor(couch.time()), couch.random_id(16)].join('-');
     },
+
+    seq_num: function(seq) {
+        /*
+        Return the number at the start of an update_seq, which might be opaque.
+
+        >>> couch.seq_num(42);
+        42
+        >>> couch.seq_num('42-g1AAAAB');
+        42
+
+        */
+        return (typeof seq == 'number') ? seq : (parseInt(seq, 10) || 0);
+    },
+
+    rev_num: function(rev) {
+        /*
+        Return the number before the dash in a doc _rev, or 0 if there is none.
+
+        >>> couch.rev_num('3-6a7d0e5f');
+        3
+
+        */
+        return rev ? parseInt(rev, 10) : 0;
+    },
 }
 
 
@@ -81,31 +105,305 @@ couch.errors = {
 }
 
 
+couch.Scheduler = function(max_active) {
+    /*
+    Limit how many async requests are active at once, by priority.
+
+    Requests wait in a queue per priority class and are started in priority
+    order as slots free up.  The last `reserved` slots are only used for
+    interactive requests, so what the user is waiting on never sits behind
+    background traffic.
+
+    All requests made through couch.CouchBase go through couch.scheduler at
+    the current priority, which is "interactive" unless changed with
+    Scheduler.at():
+
+    >>> couch.scheduler.at('prefetch', function() {
+    ...     db.get_docs(ids, callback);
+    ... });
+
+    */
+    this.max_active = max_active || 4;
+    this.active = 0;
+    this.current = 'interactive';
+    this.cancellable = true;
+    this.queues = {};
+    this.stats = {};
+    this.priorities.forEach(function(priority) {
+        this.queues[priority] = [];
+        this.stats[priority] = {
+            completed: 0, cancelled: 0, max_queued: 0, wait: 0, latency: 0,
+        };
+    }, this);
+}
+couch.Scheduler.prototype = {
+    priorities: ['interactive', 'background', 'prefetch'],
+
+    reserved: 1,
+
+    at: function(priority, func, self) {
+        /*
+        Call func.call(self), making any requests at *priority*.
+
+        A null *priority* bypasses the scheduler, for long-lived requests
+        like the continuous changes feed.
+        */
+        var previous = this.current;
+        this.current = priority;
+        try {
+            return func.call(self);
+        }
+        finally {
+            this.current = previous;
+        }
+    },
+
+    keep: function(func, self) {
+        /*
+        Call func.call(self), making requests that Scheduler.cancel() keeps.
+
+        Use this for requests whose callbacks must run, like those a
+        couch.Session makes to keep its own state consistent.  Requests other
+        than GET and HEAD are always kept.
+        */
+        var previous = this.cancellable;
+        this.cancellable = false;
+        try {
+            return func.call(self);
+        }
+        finally {
+            this.cancellable = previous;
+        }
+    },
+
+    submit: function(req, send) {
+        var queue = this.queues[req.priority];
+        if (!queue) {
+            throw 'Unknown priority: ' + req.priority;
+        }
+        req.scheduler = this;
+        req.queued_at = Date.now();
+        req.send = send;
+        queue.push(req);
+        var stats = this.stats[req.priority];
+        stats.max_queued = Math.max(stats.max_queued, queue.length);
+        this.run();
+    },
+
+    run: function() {
+        this.priorities.forEach(function(priority, i) {
+            var limit = this.max_active - ((i == 0) ? 0 : this.reserved);
+            var queue = this.queues[priority];
+            while (queue.length > 0 && this.active < limit) {
+                var req = queue.shift();
+                this.active += 1;
+                req.started_at = Date.now();
+                this.stats[priority].wait += req.started_at - req.queued_at;
+                req.send();
+            }
+        }, this);
+    },
+
+    done: function(req) {
+        /*
+        Called when an active *req* has completed or was aborted.
+        */
+        req.scheduler = null;
+        this.active -= 1;
+        var stats = this.stats[req.priority];
+        stats.completed += 1;
+        stats.latency += Date.now() - req.started_at;
+        this.run();
+    },
+
+    remove: function(req) {
+        /*
+        Called when *req* is aborted, whether it was started yet or not.
+        */
+        if (req.started_at !== undefined) {
+            this.done(req);
+            return;
+        }
+        req.scheduler = null;
+        var queue = this.queues[req.priority];
+        queue.splice(queue.indexOf(req), 1);
+        this.stats[req.priority].cancelled += 1;
+    },
+
+    cancel: function(priority) {
+        /*
+        Cancel queued requests at *priority*, or at any priority if omitted.
+
+        Call this when navigating away from what the requests were for.
+        Requests that already started aren't affected; the callbacks of
+        cancelled requests are never called.  Writes, and requests made
+        inside Scheduler.keep(), stay queued.
+        */
+        var priorities = priority ? [priority] : this.priorities;
+        priorities.forEach(function(priority) {
+            var queue = this.queues[priority];
+            var kept = [];
+            queue.forEach(function(req) {
+                if (req.cancellable) {
+                    req.scheduler = null;
+                }
+                else {
+                    kept.push(req);
+                }
+            });
+            this.stats[priority].cancelled += queue.length - kept.length;
+            this.queues[priority] = kept;
+        }, this);
+    },
+
+    metrics: function() {
+        /*
+        Return queue depth and latency metrics, with times in milliseconds.
+
+        For example:
+
+        >>> couch.scheduler.metrics().interactive;
+        {queued: 0, max_queued: 12, completed: 340, cancelled: 0,
+         avg_wait: 3.2, avg_latency: 41.5}
+
+        */
+        var metrics = {active: this.active, max_active: this.max_active};
+        this.priorities.forEach(function(priority) {
+            var stats = this.stats[priority];
+            var n = stats.completed;
+            metrics[priority] = {
+                queued: this.queues[priority].length,
+                max_queued: stats.max_queued,
+                completed: n,
+                cancelled: stats.cancelled,
+                avg_wait: (n > 0) ? stats.wait / n : null,
+                avg_latency: (n > 0) ? stats.latency / n : null,
+            };
+        }, this);
+        return metrics;
+    },
+}
+
+
+couch.scheduler = new couch.Scheduler();
+if (typeof window != 'undefined' && window.addEventListener) {
+    window.addEventListener('pagehide', function() {
+        couch.scheduler.cancel();
+    });
+}
+
+
 couch.CouchRequest = function(Request) {
     var Request = Request || XMLHttpRequest;
     this.req = new Request();
+    this.priority = couch.scheduler.current;
+    this.cancellable = couch.scheduler.cancellable;
+    this.scheduler = null;
 }
 couch.CouchRequest.prototype = {
 
     on_readystatechange: function() {
-        if (this.req.readyState == 4) {
+        if (this.req.readyState == 3 && this.progress) {
+            this.progress(this);
+        }
+        else if (this.req.readyState == 4) {
+            if (this.scheduler) {
+                this.scheduler.done(this);
+            }
             this.callback(this);
         }
     },
 
+    schedule: function(send) {
+        // Start the request now, or once couch.scheduler has a free slot:
+        if (this.priority) {
+            couch.scheduler.submit(this, send);
+        }
+        else {
+            send();
+        }
+    },
+
     request: function(callback, method, url, obj) {
         this.callback = callback;
+        if (method != 'GET' && method != 'HEAD') {
+            this.cancellable = false;  // Never drop a write
+        }
         var self = this;
         this.req.onreadystatechange = function() {
             self.on_readystatechange();
         }
-        this.do_request(true, method, url, obj);
+        this.schedule(function() {
+            self.do_request(true, method, url, obj);
+        });
     },
 
     request_sync: function(method, url, obj) {
         this.do_request(false, method, url, obj);
     },
 
+    request_binary: function(callback, method, url, body, options) {
+        /*
+        Make an async request with a binary body and/or response.
+
+        The *body* can be a Blob, ArrayBuffer, or typed array, which is sent
+        as is (a Blob is streamed from disk by WebKit).  The *options* can
+        include:
+
+            content_type: Content-Type of body (default: body.type or
+                          "application/octet-stream")
+            response_type: "blob" or "arraybuffer" for a binary response
+            progress: called with (loaded, total) as bytes are sent (when
+                      there is a body) or received; total can be null
+
+        */
+        options = options || {};
+        this.callback = callback;
+        if (method != 'GET' && method != 'HEAD') {
+            this.cancellable = false;  // Never drop a write
+        }
+        var self = this;
+        this.req.onreadystatechange = function() {
+            self.on_readystatechange();
+        }
+        this.schedule(function() {
+            self.send_binary(method, url, body, options);
+        });
+    },
+
+    send_binary: function(method, url, body, options) {
+        this.req.open(method, url, true);
+        if (options.response_type) {
+            this.req.responseType = options.response_type;
+        }
+        else {
+            this.req.setRequestHeader('Accept', 'application/json');
+        }
+        if (options.progress) {
+            var progress = options.progress;
+            var on_progress = function(event) {
+                var total = event.lengthComputable ? event.total : null;
+                progress(event.loaded, total);
+            }
+            if (body && this.req.upload) {
+                this.req.upload.onprogress = on_progress;
+            }
+            else {
+                this.req.onprogress = on_progress;
+            }
+        }
+        if (body) {
+            var content_type = options.content_type || body.type;
+            this.req.setRequestHeader('Content-Type',
+                content_type || 'application/octet-stream'
+            );
+            this.req.send(body);
+        }
+        else {
+            this.req.send();
+        }
+    },
+
     do_request: function(async, method, url, obj) {
         this.req.open(method, url, async);
         this.req.setRequestHeader('Accept', 'application/json');
@@ -137,44 +435,250 @@ couch.CouchRequest.prototype = {
             }
             throw 'ClientError';
         }
+        var type = this.req.responseType;
+        if (type == 'blob' || type == 'arraybuffer') {
+            return this.req.response;
+        }
+        if (this.result !== undefined) {
+            return this.result;
+        }
         if (this.req.getResponseHeader('Content-Type') == 'application/json') {
-            return JSON.parse(this.req.responseText);
+            this.result = JSON.parse(this.req.responseText);
+        }
+        else {
+            this.result = this.req.responseText;
         }
-        return this.req.responseText;
+        return this.result;
     },
 
     abort: function() {
+        if (this.scheduler) {
+            this.scheduler.remove(this);
+        }
+        this.req.onreadystatechange = null;
         this.req.abort();
         this.req = null;
     },
 }
 
 
-couch.ChangesMonitor = function(callback, db, since) {
+couch.CachedRequest = function(result) {
+    /*
+    Stands in for a couch.CouchRequest when a result comes from a cache.
+
+    Use read() to get the result.  For code that checks req.req.status, the
+    req attribute looks like a completed XMLHttpRequest with status 200.
+    */
+    this.result = result;
+    this.req = {readyState: 4, status: 200, statusText: 'OK'};
+}
+couch.CachedRequest.prototype = {
+    read: function() {
+        return this.result;
+    },
+
+    abort: function() {},
+}
+
+
+couch.ChangesMonitor = function(callback, db, since, longpoll) {
+    /*
+    Call *callback* with each batch of changes in *db* after *since*.
+
+    By default this follows the continuous feed, parsing rows as they arrive,
+    so a burst of writes doesn't cost a request per batch.  Set *longpoll* to
+    true to make one longpoll request per batch instead.
+
+    When a request fails, it's retried from the last seen seq after a delay
+    that doubles with each consecutive failure, up to max_delay.  If the
+    continuous feed goes missed_heartbeats * heartbeat milliseconds without
+    sending anything, not even a heartbeat, the connection is assumed dead
+    and is likewise retried.
+    */
     this.callback = callback;
     this.db = db;
     this.since = since;
+    this.longpoll = longpoll || false;
+    this.delay = 0;
+    this.offset = 0;
+    this.requests = 0;
+    this.timeout_id = null;
+    this.watchdog_id = null;
+    this.stopped = false;
     this.monitor();
 }
 couch.ChangesMonitor.prototype = {
+    heartbeat: 10000,
+
+    missed_heartbeats: 3,
+
+    min_delay: 500,
+
+    max_delay: 30000,
+
+    max_response: 4 * 1024 * 1024,
+
     monitor: function() {
+        this.timeout_id = null;
+        this.requests += 1;
         var self = this;
         var callback = function(r) {
             self.on_request(r);
         }
-        this.req = this.db.get(callback, '_changes', 
-            {feed: 'longpoll', include_docs: true, since: this.since}
-        ); 
+        if (this.longpoll) {
+            // Long-lived, so don't hold a couch.scheduler slot:
+            this.req = couch.scheduler.at(null, function() {
+                return this.db.get(callback, '_changes', 
+                    {feed: 'longpoll', include_docs: true, since: this.since}
+                );
+            }, this);
+            return;
+        }
+        var options = {
+            feed: 'continuous',
+            heartbeat: this.heartbeat,
+            include_docs: true,
+            since: this.since,
+        };
+        this.offset = 0;
+        this.req = new couch.CouchRequest(this.db.Request);
+        this.req.priority = null;  // Long-lived, don't hold a scheduler slot
+        this.req.progress = function(r) {
+            self.on_progress(r);
+        }
+        this.req.request(callback, 'GET', this.db.path('_changes', options));
+        this.reset_watchdog();
+    },
+
+    reset_watchdog: function() {
+        this.clear_watchdog();
+        var self = this;
+        this.watchdog_id = setTimeout(function() {
+            self.on_watchdog();
+        }, this.missed_heartbeats * this.heartbeat);
+    },
+
+    clear_watchdog: function() {
+        if (this.watchdog_id != null) {
+            clearTimeout(this.watchdog_id);
+            this.watchdog_id = null;
+        }
+    },
+
+    on_watchdog: function() {
+        this.watchdog_id = null;
+        if (this.stopped || !this.req) {
+            return;
+        }
+        // Not even a heartbeat, so the connection is probably half-open:
+        var req = this.req;
+        this.req = null;
+        req.abort();
+        this.retry();
+    },
+
+    stop: function() {
+        this.stopped = true;
+        this.clear_watchdog();
+        if (this.timeout_id != null) {
+            clearTimeout(this.timeout_id);
+            this.timeout_id = null;
+        }
+        if (this.req) {
+            var req = this.req;
+            this.req = null;
+            req.abort();
+        }
+    },
+
+    on_progress: function(req) {
+        /*
+        Parse the complete lines received so far on the continuous feed.
+        */
+        if (this.stopped || req.req.status != 200) {
+            return;
+        }
+        if (req === this.req) {
+            this.reset_watchdog();
+        }
+        var text = req.req.responseText;
+        var end = text.lastIndexOf('\n');
+        if (end < this.offset) {
+            return;
+        }
+        var lines = text.slice(this.offset, end).split('\n');
+        this.offset = end + 1;
+        this.delay = 0;  // Even a heartbeat means the connection is healthy
+        var results = [];
+        lines.forEach(function(line) {
+            if (!line.trim()) {
+                return;
+            }
+            var row = JSON.parse(line);
+            if (row.last_seq !== undefined) {
+                this.since = row.last_seq;
+            }
+            else {
+                this.since = row.seq;
+                results.push(row);
+            }
+        }, this);
+        if (results.length > 0) {
+            this.db.invalidate_views(this.since);
+            this.callback({results: results, last_seq: this.since});
+        }
+        if (req === this.req && this.offset > this.max_response) {
+            // Don't let responseText grow without bound, start a fresh one:
+            this.req = null;
+            req.abort();
+            this.monitor();
+        }
     },
 
     on_request: function(req) {
-        var result = req.read();
+        if (this.stopped || req !== this.req) {
+            return;
+        }
+        this.req = null;
+        if (!this.longpoll) {
+            this.clear_watchdog();
+            this.on_progress(req);
+            if (req.req.status == 200) {
+                this.monitor();  // CouchDB ended the feed, start another
+            }
+            else {
+                this.retry();
+            }
+            return;
+        }
+        try {
+            var result = req.read();
+        }
+        catch (e) {
+            this.retry();
+            return;
+        }
+        this.delay = 0;
         if (result.last_seq != this.since) {
             this.since = result.last_seq;
+            this.db.invalidate_views(this.since);
             this.callback(result);
         }
         this.monitor();
     },
+
+    retry: function() {
+        if (this.delay == 0) {
+            this.delay = this.min_delay;
+        }
+        else {
+            this.delay = Math.min(this.delay * 2, this.max_delay);
+        }
+        var self = this;
+        this.timeout_id = setTimeout(function() {
+            self.monitor();
+        }, this.delay);
+    },
 }
 
 
@@ -366,8 +870,138 @@ couch.Database = function(name, url, Request) {
     couch.CouchBase.call(this, url, Request);
     this.basepath = this.url + name + '/';
     this.name = name;
+    this.views = null;
+    this.views_size = 0;
+    this.views_seq = 0;
+    this.views_generation = 0;
+    this.view_hits = 0;
+    this.view_misses = 0;
 }
 couch.Database.prototype = {
+    request: function(callback, method, obj, parts, options) {
+        this.on_request(method, parts);
+        return couch.CouchBase.prototype.request.call(
+            this, callback, method, obj, parts, options
+        );
+    },
+
+    request_sync: function(method, obj, parts, options) {
+        this.on_request(method, parts);
+        return couch.CouchBase.prototype.request_sync.call(
+            this, method, obj, parts, options
+        );
+    },
+
+    on_request: function(method, parts) {
+        // Writes made through this Database make all cached views stale:
+        if (this.views == null || method == 'GET') {
+            return;
+        }
+        if (typeof parts == 'string') {
+            parts = [parts];
+        }
+        var last = (parts) ? parts[parts.length - 1] : null;
+        if (method == 'POST' && last == '_all_docs') {
+            return;
+        }
+        this.clear_views();
+    },
+
+    cache_views: function(max_views) {
+        /*
+        Cache the results of Database.view() and Database.view_sync().
+
+        Results are cached by design, view, and options, and are tagged with
+        the database update_seq.  They're invalidated by the changes feed
+        (couch.ChangesMonitor or a couch.Session using the Hub), and by any
+        write made through this Database, so only use this when the page
+        follows the changes feed.  At most *max_views* (default 100) results
+        are kept.  Treat cached results as read-only.
+
+        >>> db.cache_views(200);
+
+        */
+        this.max_views = max_views || 100;
+        this.clear_views();
+    },
+
+    clear_views: function() {
+        this.views = {};
+        this.views_size = 0;
+        this.views_generation += 1;
+    },
+
+    invalidate_views: function(last_seq) {
+        /*
+        Drop cached view results older than *last_seq*.
+        */
+        var seq = couch.seq_num(last_seq);
+        this.views_seq = Math.max(this.views_seq, seq);
+        if (this.views == null) {
+            return;
+        }
+        var key;
+        for (key in this.views) {
+            if (this.views[key].seq < seq) {
+                delete this.views[key];
+                this.views_size -= 1;
+            }
+        }
+    },
+
+    view_key: function(design, view, options) {
+        var keys = Object.keys(options).filter(function(key) {
+            return key != 'update_seq';  // Added by Database.view()
+        }).sort();
+        return JSON.stringify([design, view, keys.map(function(key) {
+            return [key, options[key]];
+        })]);
+    },
+
+    get_view: function(key) {
+        if (this.views == null) {
+            return null;
+        }
+        var entry = this.views[key];
+        if (!entry) {
+            this.view_misses += 1;
+            return null;
+        }
+        this.view_hits += 1;
+        // Move to the end, so the first key is the least recently used:
+        delete this.views[key];
+        this.views[key] = entry;
+        return entry.result;
+    },
+
+    put_view: function(key, generation, result) {
+        var seq = couch.seq_num(result.update_seq);
+        if (generation != this.views_generation || seq < this.views_seq) {
+            return;  // Already stale
+        }
+        if (!this.views[key]) {
+            this.views_size += 1;
+        }
+        this.views[key] = {seq: seq, result: result};
+        var oldest;
+        for (oldest in this.views) {
+            if (this.views_size <= this.max_views) {
+                break;
+            }
+            delete this.views[oldest];
+            this.views_size -= 1;
+        }
+    },
+
+    view_stats: function() {
+        return {
+            size: this.views_size,
+            hits: this.view_hits,
+            misses: this.view_misses,
+        };
+    },
+
+
     save: function(doc) {
         /*
         Save *doc* to Couch, update *doc* _id and _rev in place.
@@ -422,7 +1056,29 @@ couch.Database.prototype = {
         else if (options['reduce'] == undefined) {
             options['reduce'] = false;
         }
-        return this.get(callback, ['_design', design, '_view', view], options);
+        var parts = ['_design', design, '_view', view];
+        if (this.views == null) {
+            return this.get(callback, parts, options);
+        }
+        var key = this.view_key(design, view, options);
+        var result = this.get_view(key);
+        if (result) {
+            var req = new couch.CachedRequest(result);
+            setTimeout(function() {
+                callback(req);
+            }, 0);
+            return req;
+        }
+        var generation = this.views_generation;
+        var self = this;
+        var on_view = function(req) {
+            if (req.req.status == 200) {
+                self.put_view(key, generation, req.read());
+            }
+            callback(req);
+        }
+        options['update_seq'] = true;
+        return this.get(on_view, parts, options);
     },
 
     view_sync: function(design, view, options) {
@@ -449,7 +1105,19 @@ couch.Database.prototype = {
         else if (options['reduce'] == undefined) {
             options['reduce'] = false;
         }
-        return this.get_sync(['_design', design, '_view', view], options);
+        var parts = ['_design', design, '_view', view];
+        if (this.views == null) {
+            return this.get_sync(parts, options);
+        }
+        var key = this.view_key(design, view, options);
+        var result = this.get_view(key);
+        if (!result) {
+            var generation = this.views_generation;
+            options['update_seq'] = true;
+            result = this.get_sync(parts, options);
+            this.put_view(key, generation, result);
+        }
+        return result;
     },
 
     att_url: function(doc_or_id, name) {
@@ -505,53 +1173,209 @@ couch.Database.prototype = {
         return ['url(', JSON.stringify(url), ')'].join('');
     },
 
-    monitor_changes: function(callback, since) {
-        return new couch.ChangesMonitor(callback, this, since);
-    },
+    put_att: function(callback, doc_or_id, name, body, options) {
+        /*
+        Upload *body* (a Blob, ArrayBuffer, or typed array) as an attachment.
 
-}
-couch.Database.prototype.__proto__ = couch.CouchBase.prototype;
+        The bytes are sent as is, rather than base64 encoded in JSON.  The
+        rev is taken from *doc_or_id* if it's a doc, and the doc's _rev is
+        updated when the upload succeeds.  Besides the options accepted by
+        couch.CouchRequest.request_binary(), *options* can include the rev.
 
+        For example:
 
-couch.Session = function(db, callback) {
-    this.db = db;
-    this.callback = callback;
-    this.timeout_id = null;
-    this.docs = {};
-    this.dirty = {};
-    this.session_id = couch.random_id2();
-}
+        >>> db.put_att(callback, doc, 'thumbnail', blob, {progress: on_prog});
+
+        */
+        options = options || {};
+        var rev = options.rev;
+        if (doc_or_id instanceof Object && !rev) {
+            rev = doc_or_id._rev;
+        }
+        var url = this.att_url(doc_or_id, name);
+        if (rev) {
+            url = url + '?rev=' + encodeURIComponent(rev);
+        }
+        var on_put = function(req) {
+            if (doc_or_id instanceof Object && req.req.status == 201) {
+                doc_or_id._rev = req.read().rev;
+            }
+            callback(req);
+        }
+        this.on_request('PUT');
+        var req = new couch.CouchRequest(this.Request);
+        req.request_binary(on_put, 'PUT', url, body, options);
+        return req;
+    },
+
+    get_att: function(callback, doc_or_id, name, options) {
+        /*
+        Download an attachment as a Blob (or ArrayBuffer).
+
+        When *callback* is called, req.read() returns the Blob, or the
+        ArrayBuffer if *options* includes {response_type: 'arraybuffer'}.
+        The *options* can also include a progress callback.
+
+        For example:
+
+        >>> db.get_att(callback, doc, 'thumbnail', {progress: on_progress});
+
+        */
+        options = options || {};
+        if (!options.response_type) {
+            options.response_type = 'blob';
+        }
+        var url = this.att_url(doc_or_id, name);
+        var req = new couch.CouchRequest(this.Request);
+        req.request_binary(callback, 'GET', url, null, options);
+        return req;
+    },
+
+    monitor_changes: function(callback, since, longpoll) {
+        return new couch.ChangesMonitor(callback, this, since, longpoll);
+    },
+
+}
+couch.Database.prototype.__proto__ = couch.CouchBase.prototype;
+
+
+couch.Session = function(db, callback, hub) {
+    /*
+    Keep the docs in *db* in memory, calling *callback* for each new doc.
+
+    By default the session follows the changes feed itself.  When *hub* is
+    provided (typically the global Hub from base.js), changes instead come
+    from the "changes" signal sent by userwebkit.BaseApp, which follows a
+    single changes feed for all pages:
+
+    >>> var session = new couch.Session(db, callback, Hub);
+
+    */
+    this.db = db;
+    this.callback = callback;
+    this.hub = hub || null;
+    this.backlog = null;
+    this.timeout_id = null;
+    this.docs = {};
+    this.known = {};
+    this.used = {};
+    this.tick = 0;
+    this.size = 0;
+    this.hits = 0;
+    this.misses = 0;
+    this.evictions = 0;
+    this.ids = {};
+    this.dirty = {};
+    this.fetching = {};
+    this.fetch_queue = [];
+    this.fetch_id = null;
+    this.inflight = {};
+    this.retries = {};
+    this.requests = 0;
+    this.batch_size = 100;
+    this.delay = 150;
+    this.latency = null;
+    this.committed = 0;
+    this.conflicts = 0;
+    this.failed = 0;
+    this.wal = null;
+    this.session_id = couch.random_id2();
+}
 couch.Session.prototype = {
+    page_size: 500,
+
     start: function() {
+        /*
+        Load the docs one page at a time, then start following changes.
+
+        The callback is called for the docs in each page as soon as it
+        arrives, while the next page is being requested, so the first docs
+        show up quickly no matter how big the database is.  Changes are
+        followed from the update_seq of the first page, so none are missed.
+        */
+        if (this.hub) {
+            // Keep changes that arrive before on_loaded() is called:
+            this.backlog = [];
+            this.hub.connect('changes', this.on_hub_changes, this);
+        }
+        this.update_seq = null;
+        this.replay_wal();
+        this.get_page(null);
+    },
+
+    get_page: function(startkey) {
         var self = this;
         var on_docs = function(req) {
             self.on_docs(req);
         }
         var options = {
+            'startkey': (startkey == null) ? undefined : startkey,
             'endkey': '_',
+            'limit': this.page_size + 1,  // First row of the next page
             'update_seq': true,
             'include_docs': true,
         }
-        this.db.get(on_docs, '_all_docs', options);
+        couch.scheduler.keep(function() {
+            this.db.get(on_docs, '_all_docs', options);
+        }, this);
     },
 
     on_docs: function(req) {
         var result = req.read();
-        result.rows.forEach(function(row) {
+        if (this.update_seq == null) {
+            this.update_seq = result.update_seq;
+        }
+        var rows = result.rows;
+        var more = (rows.length > this.page_size);
+        if (more) {
+            // Request the next page before handling this one:
+            this.get_page(rows.pop().id);
+        }
+        var new_docs = [];
+        rows.forEach(function(row) {
             console.assert(row.id[0] != '_');
-            this.docs[row.id] = row.doc;
+            if (!this.known[row.id]) {
+                this.store(row.doc);
+                new_docs.push(row.doc);
+            }
         }, this);
-        var _id;
-        for (_id in this.docs) {
-            this.callback(this.docs[_id]);
+        new_docs.forEach(function(doc) {
+            this.callback(doc);
+        }, this);
+        if (!more) {
+            this.on_loaded();
         }
+    },
 
-        // Now start the changes monitor starting at the current update_seq
+    on_loaded: function() {
+        if (this.hub) {
+            var backlog = this.backlog;
+            this.backlog = null;
+            backlog.forEach(function(result) {
+                this.on_changes(result);
+            }, this);
+            return;
+        }
+
+        // Now start the changes monitor starting at the first update_seq
         var self = this;
         var on_changes = function(req) {
             self.on_changes(req);
         }
-        this.monitor = this.db.monitor_changes(on_changes, result.update_seq);
+        this.monitor = this.db.monitor_changes(on_changes, this.update_seq);
+    },
+
+    on_hub_changes: function(dbname, result) {
+        if (dbname != this.db.name) {
+            return;
+        }
+        this.db.invalidate_views(result.last_seq);
+        if (this.backlog) {
+            this.backlog.push(result);
+        }
+        else {
+            this.on_changes(result);
+        }
     },
 
     on_changes: function(result) {
@@ -565,13 +1389,25 @@ couch.Session.prototype = {
             if (row.doc.session_id == this.session_id) {
                 return;
             }
-            if (!this.docs[row.id]) {
+            var current = this.docs[row.id];
+            var rev = couch.rev_num(row.doc._rev);
+            if (current && couch.rev_num(current._rev) >= rev) {
+                return;  // Already have this (or a newer) revision
+            }
+            if (!this.known[row.id]) {
                 new_docs.push(row.doc);
             }
+            else if (!current) {
+                // Evicted (so not subscribed to), get_doc() will re-fetch it:
+                if (row.doc._deleted) {
+                    delete this.known[row.id];
+                }
+                return;
+            }
             else {
                 changed_docs.push(row.doc);
             }
-            this.docs[row.id] = row.doc;
+            this.store(row.doc);
         }, this);
 
         // Now call callback for new docs
@@ -585,25 +1421,115 @@ couch.Session.prototype = {
         }, this);
     },
 
-    on_complete: function(req) {
-        this.req = null;
-        var rows = req.read();
-        rows.forEach(function(row) {
-            if (row.rev) {
-                this.docs[row.id]._rev = row.rev;
+    get_doc: function(_id, callback, self) {
+        /*
+        Get the doc with *_id*, from memory when possible.
+
+        Without a *callback*, a cache miss is fetched with a synchronous
+        request and the doc is returned.  Prefer passing a *callback*, which
+        is called with the doc (or null if it doesn't exist), see
+        Session.get_docs():
+
+        >>> session.get_doc(_id, this.on_doc, this);
+
+        */
+        if (!callback) {
+            var doc = this.lookup(_id);
+            if (!doc) {
+                doc = this.db.get_sync(_id);
+                this.store(doc);
+            }
+            return doc;
+        }
+        this.get_docs([_id], function(docs) {
+            callback.call(self, docs[0]);
+        });
+    },
+
+    get_docs: function(ids, callback, self) {
+        /*
+        Call *callback* with the docs for *ids*, in order (null if missing).
+
+        If all the docs are in memory, *callback* is called right away.
+        Otherwise all the misses from the current tick (across all calls) are
+        fetched with a single _all_docs request, and a doc already being
+        fetched isn't requested again.
+
+        >>> session.get_docs([id1, id2], this.on_docs, this);
+
+        */
+        var results = ids.map(this.lookup, this);
+        var waiting = 0;
+        results.forEach(function(doc, i) {
+            if (doc) {
+                return;
             }
+            waiting += 1;
+            this.fetch(ids[i], function(doc) {
+                results[i] = doc;
+                waiting -= 1;
+                if (waiting == 0) {
+                    callback.call(self, results);
+                }
+            });
         }, this);
-        if (this.pending) {
-            this.pending = false;
-            this.commit();
+        if (waiting == 0) {
+            callback.call(self, results);
         }
     },
 
-    get_doc: function(_id) {
-        if (!this.docs[_id]) {
-            this.docs[_id] = this.db.get_sync(_id);
+    fetch: function(_id, callback) {
+        if (this.fetching[_id]) {
+            this.fetching[_id].push(callback);
+            return;
+        }
+        this.fetching[_id] = [callback];
+        this.fetch_queue.push(_id);
+        if (this.fetch_id == null) {
+            var self = this;
+            this.fetch_id = setTimeout(function() {
+                self.flush_fetch();
+            }, 0);
+        }
+    },
+
+    flush_fetch: function() {
+        this.fetch_id = null;
+        var keys = this.fetch_queue;
+        this.fetch_queue = [];
+        var self = this;
+        var callback = function(req) {
+            self.on_fetch(keys, req);
         }
-        return this.docs[_id];
+        var options = {include_docs: true};
+        this.db.post(callback, {keys: keys}, '_all_docs', options);
+    },
+
+    on_fetch: function(keys, req) {
+        try {
+            var rows = req.read().rows;
+        }
+        catch (e) {
+            console.error('Session could not fetch docs: ' + e);
+            var rows = [];
+        }
+        var found = {};
+        rows.forEach(function(row) {
+            // Deleted and missing docs have no row.doc:
+            if (row.doc) {
+                if (!this.docs[row.id]) {
+                    this.store(row.doc);
+                }
+                found[row.id] = this.docs[row.id] || row.doc;
+            }
+        }, this);
+        keys.forEach(function(_id) {
+            var callbacks = this.fetching[_id];
+            delete this.fetching[_id];
+            callbacks.forEach(function(callback) {
+                callback(found[_id] || null);
+            });
+        }, this);
     },
 
     save: function(doc, no_emit) {
@@ -615,8 +1541,10 @@ couch.Session.prototype = {
         */
         this.dirty[doc._id] = doc;
         doc.session_id = this.session_id;
-        if (!this.docs[doc._id]) {
-            this.docs[doc._id] = doc;
+        this.wal_write(doc);
+        var known = this.known[doc._id];
+        this.store(doc);
+        if (!known) {
             this.callback(doc);
         }
         else if (!no_emit) {
@@ -624,25 +1552,479 @@ couch.Session.prototype = {
         }
     },
 
+    max_docs: 10000,  // Docs kept in memory, not counting pinned docs
+
+    lookup: function(_id) {
+        /*
+        Return the doc with *_id* if it's in memory, otherwise undefined.
+        */
+        var doc = this.docs[_id];
+        if (doc) {
+            this.hits += 1;
+            this.used[_id] = ++this.tick;
+        }
+        else {
+            this.misses += 1;
+        }
+        return doc;
+    },
+
+    store: function(doc) {
+        var _id = doc._id;
+        if (!this.docs[_id]) {
+            this.size += 1;
+        }
+        this.docs[_id] = doc;
+        this.known[_id] = true;
+        this.used[_id] = ++this.tick;
+        if (this.size > this.max_docs) {
+            this.evict();
+        }
+    },
+
+    is_pinned: function(_id) {
+        return !!(this.dirty[_id] || this.inflight[_id] || this.ids[_id]);
+    },
+
+    evict: function() {
+        /*
+        Evict least recently used docs until 90% of max_docs remain.
+
+        Docs that are dirty, being committed, or subscribed to are pinned.
+        */
+        var target = Math.floor(this.max_docs * 0.9);
+        var candidates = Object.keys(this.docs).filter(function(_id) {
+            return !this.is_pinned(_id);
+        }, this);
+        var used = this.used;
+        candidates.sort(function(a, b) {
+            return used[a] - used[b];
+        });
+        var i;
+        for (i = 0; i < candidates.length && this.size > target; i++) {
+            var _id = candidates[i];
+            delete this.docs[_id];
+            delete this.used[_id];
+            this.size -= 1;
+            this.evictions += 1;
+        }
+    },
+
+    cache_stats: function() {
+        /*
+        Return stats about the in-memory docs.
+
+        For example:
+
+        >>> session.cache_stats();
+        {size: 9000, max_docs: 10000, hits: 1500, misses: 500,
+         hit_rate: 0.75, evictions: 1100}
+
+        */
+        var lookups = this.hits + this.misses;
+        return {
+            size: this.size,
+            max_docs: this.max_docs,
+            hits: this.hits,
+            misses: this.misses,
+            hit_rate: (lookups > 0) ? this.hits / lookups : null,
+            evictions: this.evictions,
+        };
+    },
+
+    max_requests: 2,  // Concurrent _bulk_docs requests
+
+    min_batch: 10,
+
+    max_batch: 1000,
+
+    max_body: 1024 * 1024,  // Bytes of JSON per request, unless 1 huge doc
+
+    target_latency: 250,  // Milliseconds, batch_size adapts to this
+
+    min_delay: 50,
+
+    max_delay: 2000,
+
+    max_retries: 3,  // For each doc, after a conflict
+
     commit: function() {
+        /*
+        Save dirty docs, in up to max_requests concurrent batches.
+
+        A doc is never in two batches at once: if it's saved again while
+        being committed, the new version waits for the first to complete so
+        it gets the new _rev.
+        */
+        while (this.requests < this.max_requests) {
+            var docs = this.next_batch();
+            if (docs.length == 0) {
+                break;
+            }
+            this.send_batch(docs);
+        }
+    },
+
+    next_batch: function() {
         var docs = [];
+        var size = 0;
         var _id;
         for (_id in this.dirty) {
-            docs.push(this.dirty[_id]);
+            if (this.inflight[_id]) {
+                continue;
+            }
+            var doc = this.dirty[_id];
+            var length = JSON.stringify(doc).length;
+            if (docs.length > 0 && size + length > this.max_body) {
+                break;
+            }
+            docs.push(doc);
+            size += length;
+            delete this.dirty[_id];
+            this.inflight[_id] = doc;
+            if (docs.length >= this.batch_size) {
+                break;
+            }
         }
-        if (docs.length == 0) {
+        return docs;
+    },
+
+    send_batch: function(docs) {
+        this.requests += 1;
+        var start = Date.now();
+        var self = this;
+        var callback = function(req) {
+            self.on_complete(docs, start, req);
+        }
+        this.db.post(callback, {docs: docs}, '_bulk_docs');
+    },
+
+    on_complete: function(docs, start, req) {
+        this.requests -= 1;
+        try {
+            var rows = req.read();
+        }
+        catch (e) {
+            // Whole request failed, requeue the docs and back off:
+            console.error('Session commit failed: ' + e);
+            docs.forEach(function(doc) {
+                delete this.inflight[doc._id];
+                if (!this.dirty[doc._id]) {
+                    this.dirty[doc._id] = doc;
+                }
+            }, this);
+            this.delay = Math.min(this.delay * 2, this.max_delay);
+            this.delayed_commit();
             return;
         }
-        if (this.req) {
-            this.pending = true;
+        this.adapt(Date.now() - start);
+        rows.forEach(function(row, i) {
+            var doc = docs[i];
+            delete this.inflight[doc._id];
+            if (row.rev) {
+                doc._rev = row.rev;
+                if (this.docs[row.id]) {
+                    this.docs[row.id]._rev = row.rev;
+                }
+                if (this.dirty[row.id]) {
+                    this.dirty[row.id]._rev = row.rev;
+                }
+                delete this.retries[row.id];
+                this.committed += 1;
+                this.wal_done(doc);
+            }
+            else if (row.error == 'conflict') {
+                this.on_conflict(doc);
+            }
+            else {
+                this.on_failed(doc, row.error);
+            }
+        }, this);
+        this.commit();
+    },
+
+    adapt: function(elapsed) {
+        /*
+        Adapt batch_size and delay to the observed request latency.
+        */
+        if (this.latency == null) {
+            this.latency = elapsed;
+        }
+        else {
+            this.latency = 0.8 * this.latency + 0.2 * elapsed;
+        }
+        if (this.latency < this.target_latency) {
+            this.batch_size = Math.min(this.batch_size * 2, this.max_batch);
+        }
+        else {
+            this.batch_size = Math.max(
+                Math.floor(this.batch_size / 2), this.min_batch
+            );
+        }
+        this.delay = Math.min(
+            Math.max(Math.round(this.latency / 2), this.min_delay),
+            this.max_delay
+        );
+    },
+
+    on_conflict: function(doc) {
+        var tries = (this.retries[doc._id] || 0) + 1;
+        if (tries > this.max_retries) {
+            delete this.retries[doc._id];
+            this.on_failed(doc, 'conflict');
             return;
         }
-        this.dirty = {};
+        this.retries[doc._id] = tries;
+        this.conflicts += 1;
+        this.inflight[doc._id] = doc;  // Keep later saves waiting
         var self = this;
         var callback = function(req) {
-            self.on_complete(req);
+            self.on_current(doc, req);
+        }
+        couch.scheduler.keep(function() {
+            this.db.get(callback, doc._id);
+        }, this);
+    },
+
+    on_current: function(doc, req) {
+        delete this.inflight[doc._id];
+        try {
+            var current = req.read();
+        }
+        catch (e) {
+            this.on_failed(doc, e);
+            return;
+        }
+        // Merge into the newest local version, it might have been saved again:
+        var local = this.dirty[doc._id] || doc;
+        if (!this.merge(local, current)) {
+            delete this.dirty[doc._id];
+            delete this.retries[doc._id];
+            this.on_failed(local, 'conflict');
+            // Show what's actually in CouchDB:
+            this.store(current);
+            this.emit(current);
+            this.commit();
+            return;
+        }
+        local._rev = current._rev;
+        this.dirty[doc._id] = local;
+        this.wal_write(local);
+        this.commit();
+    },
+
+    merge: function(doc, current) {
+        /*
+        Merge *current*, the latest revision from CouchDB, into *doc*.
+
+        Return true if *doc* was updated in place and should be saved again.
+        By default this returns false, so the conflict is reported, the local
+        changes are dropped and *current* replaces *doc*.  Override this for
+        documents where a merge makes sense, for example:
+
+        >>> session.merge = function(doc, current) {
+        ...     doc.count = Math.max(doc.count, current.count);
+        ...     return true;
+        ... };
+
+        */
+        return false;
+    },
+
+    on_failed: function(doc, error) {
+        this.failed += 1;
+        console.error('Session could not save ' + doc._id + ': ' + error);
+        this.wal_done(doc);  // Retrying won't help
+    },
+
+    wal_heartbeat: 5000,  // Milliseconds between WAL liveness updates
+
+    wal_stale: 15000,  // A session not heard from for this long is gone
+
+    use_wal: function(storage) {
+        /*
+        Keep dirty docs in a write-ahead log in *storage* until committed.
+
+        The *storage* defaults to window.localStorage.  Every save() is
+        written to the log right away.  Failed commits are retried with
+        backoff until CouchDB is back.  Call this before Session.start():
+
+        >>> session.use_wal();
+        >>> session.start();
+
+        Each session logs under its own session_id and refreshes a liveness
+        marker every wal_heartbeat milliseconds, so pages sharing the storage
+        (say, several windows) never replay each other's docs.  Session.start()
+        and each heartbeat after it replay, in the order they were saved, the
+        docs left by sessions that are gone: their page was closed, or their
+        marker went stale after a crash.
+        */
+        this.wal = storage || window.localStorage;
+        // Database names can contain "/", which separates the key parts:
+        var name = encodeURIComponent(this.db.name);
+        this.wal_base = 'couch.wal.' + name + '/';
+        this.wal_prefix = this.wal_base + this.session_id + '/';
+        this.wal_live_base = 'couch.wal-live.' + name + '/';
+        this.wal_n = 0;
+        this.wal_mark(this.session_id);
+        var self = this;
+        var tick = function() {
+            self.wal_mark(self.session_id);
+            self.replay_wal();
+            setTimeout(tick, self.wal_heartbeat);
+        }
+        setTimeout(tick, this.wal_heartbeat);
+        if (typeof window != 'undefined' && window.addEventListener) {
+            window.addEventListener('pagehide', function() {
+                // Any docs still logged can now be replayed by another page:
+                self.wal.removeItem(self.wal_live_base + self.session_id);
+            });
         }
-        this.req = this.db.post(callback, {docs: docs}, '_bulk_docs');
+    },
+
+    wal_mark: function(owner) {
+        /*
+        Mark the log of session *owner* as in use by this session.
+        */
+        var marker = JSON.stringify({t: Date.now(), by: this.session_id});
+        try {
+            this.wal.setItem(this.wal_live_base + owner, marker);
+        }
+        catch (e) {
+            console.error('Session could not mark WAL: ' + e);
+        }
+    },
+
+    wal_marker: function(owner) {
+        var marker = this.wal.getItem(this.wal_live_base + owner);
+        return marker ? JSON.parse(marker) : null;
+    },
+
+    wal_alive: function(owner) {
+        var marker = this.wal_marker(owner);
+        return marker != null && Date.now() - marker.t < this.wal_stale;
+    },
+
+    wal_keys: function(prefix) {
+        var keys = [];
+        var i;
+        for (i = 0; i < this.wal.length; i++) {
+            var key = this.wal.key(i);
+            if (key.indexOf(prefix) == 0) {
+                keys.push(key);
+            }
+        }
+        return keys;
+    },
+
+    wal_orphans: function() {
+        /*
+        Return the session_ids of logs whose owner is gone.
+        */
+        var owners = {};
+        this.wal_keys(this.wal_base).forEach(function(key) {
+            var owner = key.slice(this.wal_base.length).split('/')[0];
+            owners[owner] = true;
+        }, this);
+        delete owners[this.session_id];
+        // Forget stale markers, their logs (if any) are orphans below:
+        this.wal_keys(this.wal_live_base).forEach(function(key) {
+            var owner = key.slice(this.wal_live_base.length);
+            if (owner != this.session_id && !this.wal_alive(owner)) {
+                this.wal.removeItem(key);
+            }
+        }, this);
+        return Object.keys(owners).filter(function(owner) {
+            return !this.wal_alive(owner);
+        }, this);
+    },
+
+    replay_wal: function() {
+        if (!this.wal) {
+            return;
+        }
+        var replayed = false;
+        this.wal_orphans().forEach(function(owner) {
+            // Claim the log, unless another page just did:
+            this.wal_mark(owner);
+            if (this.wal_marker(owner).by != this.session_id) {
+                return;
+            }
+            var prefix = this.wal_base + owner + '/';
+            var keys = this.wal_keys(prefix);
+            var entries = keys.map(function(key) {
+                return JSON.parse(this.wal.getItem(key));
+            }, this);
+            entries.sort(function(a, b) {
+                return a.n - b.n;
+            });
+            // save() logs each doc again, under this session:
+            entries.forEach(function(entry) {
+                this.save(entry.doc, true);
+            }, this);
+            keys.forEach(function(key) {
+                this.wal.removeItem(key);
+            }, this);
+            this.wal.removeItem(this.wal_live_base + owner);
+            replayed = replayed || entries.length > 0;
+        }, this);
+        if (replayed) {
+            this.commit();
+        }
+    },
+
+    wal_write: function(doc) {
+        if (!this.wal) {
+            return;
+        }
+        this.wal_n += 1;
+        var entry = JSON.stringify({n: this.wal_n, doc: doc});
+        try {
+            this.wal.setItem(this.wal_prefix + doc._id, entry);
+        }
+        catch (e) {
+            console.error('Session could not log ' + doc._id + ': ' + e);
+        }
+    },
+
+    wal_done: function(doc) {
+        /*
+        Called once *doc* was committed (or can't ever be).
+        */
+        if (!this.wal) {
+            return;
+        }
+        var dirty = this.dirty[doc._id];
+        if (dirty) {
+            // Saved again meanwhile, log the newer version with the new _rev:
+            this.wal_write(dirty);
+        }
+        else {
+            this.wal.removeItem(this.wal_prefix + doc._id);
+        }
+    },
+
+    counters: function() {
+        /*
+        Return counters describing the commit pipeline.
+
+        For example:
+
+        >>> session.counters();
+        {queued: 3, in_flight: 120, failed: 0, committed: 5460, conflicts: 2,
+         requests: 2, batch_size: 160, delay: 92}
+
+        */
+        return {
+            queued: Object.keys(this.dirty).length,
+            in_flight: Object.keys(this.inflight).length,
+            failed: this.failed,
+            committed: this.committed,
+            conflicts: this.conflicts,
+            requests: this.requests,
+            batch_size: this.batch_size,
+            delay: this.delay,
+        };
     },
 
     delayed_commit: function() {
@@ -653,13 +2035,12 @@ couch.Session.prototype = {
                 self.commit();
             }
             /* CouchDB will flush its buffer every ~1000ms, so we want
-            something fairly aperiodic to that:  */
-            this.timeout_id = setTimeout(callback, 150);
+            something fairly aperiodic to that.  The delay starts at 150ms,
+            then adapts to the commit latency: */
+            this.timeout_id = setTimeout(callback, this.delay);
         } 
     },
 
-    ids: {},
-
     subscribe: function(_id, callback, self) {
         /*
         Subscribe to changes on the doc with *_id*.
@@ -675,6 +2056,27 @@ couch.Session.prototype = {
         this.ids[_id].push({callback: callback, self: self});
     },
 
+    unsubscribe: function(_id, callback, self) {
+        /*
+        Remove a handler added with Session.subscribe().
+
+        Once a doc has no handlers it's no longer pinned in memory.
+        */
+        var handlers = this.ids[_id];
+        if (!handlers) {
+            return;
+        }
+        handlers = handlers.filter(function(h) {
+            return h.callback !== callback || h.self !== self;
+        });
+        if (handlers.length > 0) {
+            this.ids[_id] = handlers;
+        }
+        else {
+            delete this.ids[_id];
+        }
+    },
+
     emit: function(doc) {
         var handlers = this.ids[doc._id];
         if (handlers) {
@@ -24,171 +24,378 @@
 """
 
 import sys
+import os
 from os import path
-from urllib.parse import urlparse, parse_qsl
+from urllib.parse import urlparse, parse_qsl, unquote
 import json
-import optparse
 import logging
+import socket
+import time
+import threading
+from collections import OrderedDict, deque
+from functools import lru_cache, partial
+from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor
 
-import microfiber
-from microfiber import _oauth_header, basic_auth_header
-import dbus
-from dbus.mainloop.glib import DBusGMainLoop
-from gi.repository import GLib, GObject, Gtk, WebKit
+from gi.repository import GLib, GObject
 
 
 __version__ = '16.07.0'
 APPS = '/usr/share/couchdb/apps/'
-GObject.threads_init()
-DBusGMainLoop(set_as_default=True)
+CHUNK_SIZE = 64 * 1024  # Hub messages larger than this are sent in chunks
+ASSET_EXTENSIONS = frozenset([
+    '.js', '.css', '.png', '.jpg', '.jpeg', '.gif', '.svg', '.ico',
+    '.woff', '.woff2', '.ttf', '.otf', '.json',
+])
 log = logging.getLogger('userwebkit')
+_initialized = False
 
 
-def handler(d):
-    assert path.abspath(d) == d
-    return 	'{{couch_httpd_misc_handlers, handle_utils_dir_req, {}}}'.format(
-        json.dumps(d)
-    )
+def init():
+    """
+    Do the global GObject and DBus initialization needed by a UserWebKit app.
 
+    This is called automatically by `BaseApp.run()` and when a `CouchView` is
+    created, so most code never needs to call it directly.  It's safe to call
+    more than once.
+    """
+    global _initialized
+    if _initialized:
+        return
+    from dbus.mainloop.glib import DBusGMainLoop
+    GObject.threads_init()
+    DBusGMainLoop(set_as_default=True)
+    _initialized = True
 
-class CouchView(WebKit.WebView):
-    __gsignals__ = {
-        'open': (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE,
-            [GObject.TYPE_PYOBJECT]
-        ),
-    }
 
-    def __init__(self, env=None, dmedia_resolver=None):
-        super().__init__()
-        self._logging_enabled = False
-        self.connect('resource-request-starting', self._on_request)
-        self.connect('navigation-policy-decision-requested',
-            self._on_nav_policy_decision
-        )
-        self.set_env(env)
-        self._dmedia_resolver = dmedia_resolver
-
-    def set_env(self, env):
-        self._env = env
-        if env is None:
-            self._u = None
-            self._oauth = None
-            self._authorization = None
-            return
-        self._u = urlparse(env['url'])
-        self._oauth = env.get('oauth')
-        authorization = env.get('authorization')
-        if authorization is None:
-            basic = env.get('basic')
-            if basic is not None:
-                authorization = basic_auth_header(basic)
-        self._authorization = authorization
-
-    def enable_logging(self):
-        if not self._logging_enabled:
-            self._logging_enabled = True
-            self.connect('console-message', self._on_console_message)
-
-    def _on_console_message(self, view, message, line, source_id):
-        log.debug('%s @%s: %s', source_id, line, message)
-
-    def _on_request(self, view, frame, resource, request, response):
-        if self._env is None:
-            return
-        uri = request.get_uri()
-        message = request.get_message()
-        if uri.startswith('dmedia:'):
-            if self._dmedia_resolver is None:
-                request.set_uri('')
-            else:
-                _id = uri[7:]
-                (_id, status, filename) = self._dmedia_resolver(_id)
-                if status == 0:
-                    request.set_uri('file://' + filename)
-                else:
-                    request.set_uri('')
-            return
-        u = urlparse(uri)
-        if u.netloc != self._u.netloc:
-            return
-        if u.scheme != self._u.scheme:
-            return
-        if self._oauth:
-            query = dict(parse_qsl(u.query))
-            if u.query and not query:
-                query = {u.query: ''}
-            baseurl = ''.join([u.scheme, '://', u.netloc, u.path])
-            method = message.method
-            h = _oauth_header(self._oauth, method, baseurl, query)
-            authorization = h['authorization']
-        else:
-            authorization = self._authorization
-        if authorization is not None:
-            message.request_headers.append('authorization', authorization)
+@lru_cache(maxsize=512)
+def parse_uri(uri):
+    """
+    Return ``(baseurl, query)`` needed to OAuth sign a request for *uri*.
 
-    def _on_nav_policy_decision(self, view, frame, request, nav, policy):
-        """
-        Handle user trying to Navigate away from current page.
+    The *query* is returned as a tuple of ``(key, value)`` pairs so that the
+    cached result can't be modified by the caller.  For example:
+
+    >>> parse_uri('http://localhost:5984/foo/bar?limit=10')
+    ('http://localhost:5984/foo/bar', (('limit', '10'),))
+
+    A query that has no key/value pairs is treated as a single key:
+
+    >>> parse_uri('http://localhost:5984/foo?bar')
+    ('http://localhost:5984/foo', (('bar', ''),))
+
+    Results are kept in a bounded LRU cache, as pages tend to request the same
+    attachment and view URIs over and over.
+    """
+    u = urlparse(uri)
+    query = tuple(parse_qsl(u.query))
+    if u.query and not query:
+        query = ((u.query, ''),)
+    baseurl = ''.join([u.scheme, '://', u.netloc, u.path])
+    return (baseurl, query)
+
+
+def iter_chunks(data, size):
+    """
+    Yield ``(chunk, more)`` for each *size* long piece of *data*.
+
+    For example:
+
+    >>> list(iter_chunks('abcdefg', 3))
+    [('abc', True), ('def', True), ('g', False)]
+
+    """
+    for start in range(0, len(data), size):
+        end = start + size
+        yield (data[start:end], end < len(data))
+
+
+def asset_filename(directory, relpath):
+    """
+    Return the file in *directory* for the static asset at *relpath*.
+
+    For example:
+
+    >>> asset_filename('/usr/share/couchdb/apps/foo', 'base.js?v=2')
+    '/usr/share/couchdb/apps/foo/base.js'
+    >>> asset_filename('/usr/share/couchdb/apps/foo', 'img/a%20b.png')
+    '/usr/share/couchdb/apps/foo/img/a b.png'
+
+    Pages are always loaded from CouchDB so they get the right origin, and
+    *relpath* can't escape *directory*, so in these cases None is returned:
+
+    >>> asset_filename('/usr/share/couchdb/apps/foo', 'index.html') is None
+    True
+    >>> asset_filename('/usr/share/couchdb/apps/foo', '../bar/base.js') is None
+    True
+
+    """
+    relpath = unquote(relpath.split('?', 1)[0].split('#', 1)[0])
+    if path.splitext(relpath)[1].lower() not in ASSET_EXTENSIONS:
+        return None
+    filename = path.normpath(path.join(directory, relpath))
+    if not filename.startswith(path.join(directory, '')):
+        return None
+    return filename
+
+
+def design_hash(doc):
+    """
+    Return a hash of the content of design *doc*, ignoring its ``_rev``.
+
+    For example:
+
+    >>> design_hash({'_id': '_design/foo', 'views': {}})
+    '28bca7f19dfe60ebdfe79a2d8af62c9296e1c9d7'
+    >>> design_hash({'_id': '_design/foo', '_rev': '1-abc', 'views': {}})
+    '28bca7f19dfe60ebdfe79a2d8af62c9296e1c9d7'
+
+    """
+    content = dict((k, v) for (k, v) in doc.items() if k != '_rev')
+    data = json.dumps(content, sort_keys=True, separators=(',', ':'))
+    return sha1(data.encode('utf-8')).hexdigest()
+
+
+def ensure_database(db, designs):
+    """
+    Create *db* if needed, then save any of *designs* that have changed.
+
+    Saving a design doc makes CouchDB rebuild its views, so a design doc is
+    only saved when its `design_hash()` differs from the one in *db*.  All the
+    current design docs are fetched with a single request.
 
-        Note that this will be called before `CouchView._on_resource_request()`.
+    Returns a list of the IDs of the design docs that were saved.
+    """
+    db.ensure()
+    if not designs:
+        return []
+    ids = [doc['_id'] for doc in designs]
+    rows = db.post({'keys': ids}, '_all_docs', include_docs=True)['rows']
+    saved = []
+    for (doc, row) in zip(designs, rows):
+        old = row.get('doc')
+        if old is not None and design_hash(old) == design_hash(doc):
+            continue
+        new = dict(doc)
+        new.pop('_rev', None)
+        if old is not None:
+            new['_rev'] = old['_rev']
+        db.save(new)
+        saved.append(doc['_id'])
+    return saved
 
-        The *policy* arg is a ``WebPolicyDecision`` instance.  To handle the
-        decision, call one of:
 
-            * ``WebPolicyDecision.ignore()``
-            * ``WebPolicyDecision.use()``
-            * ``WebPolicyDecision.download()``
+def handler(d):
+    assert path.abspath(d) == d
+    return 	'{{couch_httpd_misc_handlers, handle_utils_dir_req, {}}}'.format(
+        json.dumps(d)
+    )
 
-        And then return ``True``.
 
-        Otherwise, return ``False`` or ``None`` to have the WebKit default
-        behavior apply.
+class BackgroundTask:
+    """
+    A call running in a worker thread, whose result is delivered on the main
+    loop.
+
+    When ``func(*args)`` returns, ``callback(result)`` is called from the
+    GLib main loop.  If it raises an exception, ``error_callback(exception)``
+    is called instead, or the exception is logged when there is no
+    *error_callback*.  Once `BackgroundTask.cancel()` is called, neither will
+    be called.
+    """
+
+    def __init__(self, func, args, callback=None, error_callback=None):
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.error_callback = error_callback
+        self.cancelled = False
+        self.future = None
+        self._done = threading.Event()
+
+    def cancel(self):
         """
-        if self._env is None:
-            return
-        uri = request.get_uri()
-        u = urlparse(uri)
-        if u.netloc == self._u.netloc or u.scheme == 'file':
-            return False
-        if u.scheme in ('http', 'https'):
-            self.emit('open', uri)
-        policy.ignore()
-        return True
-
-
-class Inspector(Gtk.VBox):
-    def __init__(self, env):
-        super().__init__()
-
-        hbox = Gtk.HBox()
-        self.pack_start(hbox, False, False, 0)
+        Cancel the task, if it hasn't already been delivered.
 
-        close = Gtk.Button(stock=Gtk.STOCK_CLOSE)
-        hbox.pack_start(close, False, False, 2)
-        close.connect('clicked', self.on_close)
+        A task that hasn't started yet won't be run at all.
+        """
+        self.cancelled = True
+        if self.future is not None:
+            self.future.cancel()
 
-        self.reload = Gtk.Button('Reload')
-        hbox.pack_start(self.reload, False, False, 2)
+    def wait(self, timeout=None):
+        """
+        Wait for the worker thread to finish, return True if it has.
+        """
+        return self._done.wait(timeout)
 
-        self.futon = Gtk.Button('CouchDB Futon')
-        hbox.pack_start(self.futon, False, False, 2)
+    def run(self):
+        # Called in the worker thread:
+        try:
+            if not self.cancelled:
+                result = self.func(*self.args)
+                GLib.idle_add(self.deliver, result, None)
+        except Exception as e:
+            GLib.idle_add(self.deliver, None, e)
+        finally:
+            self._done.set()
+
+    def deliver(self, result, error):
+        # Called from the main loop:
+        if self.cancelled:
+            return False
+        if error is None:
+            if self.callback is not None:
+                self.callback(result)
+        elif self.error_callback is not None:
+            self.error_callback(error)
+        else:
+            log.error('Error in background %r: %r', self.func, error)
+        return False
+
+
+def run_in_thread(func, *args, callback=None, error_callback=None):
+    """
+    Run ``func(*args)`` in a new daemon thread, return a `BackgroundTask`.
+
+    This is the fallback used when no shared thread pool is available, see
+    `BaseApp.run_in_background()`.
+    """
+    task = BackgroundTask(func, args, callback, error_callback)
+    thread = threading.Thread(target=task.run, daemon=True)
+    thread.start()
+    return task
+
+
+class DmediaCache:
+    """
+    TTL and LRU cache in front of a Dmedia ``Resolve``-style callback.
+
+    The *resolver* is called with a Dmedia file ID and should return an
+    ``(_id, status, filename)`` tuple, where a *status* of ``0`` means the file
+    is available locally.  Both successful and failed results are cached, but
+    failed results expire after the shorter *negative_ttl* so files that show
+    up later will be found.
+
+    If provided, *resolve_many* is called with a list of IDs and should return
+    a list of ``(_id, status, filename)`` tuples; this lets
+    `DmediaCache.prefetch()` resolve a batch of IDs in a single call.
+
+    Prefetching is done with *background*, which has the same signature as
+    `BaseApp.run_in_background()` and defaults to `run_in_thread()`.
+    """
+
+    def __init__(self, resolver, resolve_many=None, size=2048, ttl=300,
+            negative_ttl=10, background=None):
+        self.resolver = resolver
+        self.resolve_many = resolve_many
+        self.background = (run_in_thread if background is None else background)
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, _id):
+        """
+        Return cached ``(_id, status, filename)`` for *_id*, or ``None``.
+        """
+        with self._lock:
+            entry = self._entries.get(_id)
+            if entry is None:
+                return None
+            (expires, result) = entry
+            if expires <= time.monotonic():
+                del self._entries[_id]
+                return None
+            self._entries.move_to_end(_id)
+            return result
+
+    def store(self, result):
+        (_id, status, filename) = result
+        ttl = (self.ttl if status == 0 else self.negative_ttl)
+        with self._lock:
+            self._entries[_id] = (time.monotonic() + ttl, tuple(result))
+            self._entries.move_to_end(_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def resolve(self, _id):
+        """
+        Return ``(_id, status, filename)``, only calling the resolver on a miss.
+        """
+        result = self.get(_id)
+        if result is None:
+            result = tuple(self.resolver(_id))
+            self.store(result)
+        return result
+
+    def _resolve_many(self, ids):
+        if self.resolve_many is not None:
+            results = self.resolve_many(ids)
+        else:
+            results = [self.resolver(_id) for _id in ids]
+        for result in results:
+            self.store(result)
+        return results
 
-        scroll = Gtk.ScrolledWindow()
-        self.pack_start(scroll, True, True, 0)
-        scroll.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
+    def prefetch(self, ids, callback=None):
+        """
+        Resolve all uncached *ids* in a background thread.
 
-        self.view = CouchView(env)
-        scroll.add(self.view)
+        If provided, *callback* is called from the main loop with the list of
+        results once the batch has been resolved.
 
-    def on_close(self, button):
-        self.destroy()
+        Returns the `BackgroundTask`, or ``None`` when all *ids* were already
+        cached.
+        """
+        missing = []
+        for _id in ids:
+            if _id not in missing and self.get(_id) is None:
+                missing.append(_id)
+        if not missing:
+            return
+        return self.background(self._resolve_many, missing, callback=callback)
 
 
 class Hub(GObject.GObject):
-    def __init__(self, view):
+    def __init__(self, view, batch=False, chunk_size=CHUNK_SIZE):
         super().__init__()
         self._view = view
-        view.connect('notify::title', self._on_notify_title)
+        self._batch = batch
+        self._chunk_size = chunk_size
+        self._queue = []
+        self._flush_id = None
+        self._outgoing = deque()
+        self._pump_id = None
+        self._transfers = 0
+        self._session = None
+        self._last_i = -1
+        self._chunks = []
+        self.gaps = 0
+        self.bus = None
+        self._title_id = view.connect('notify::title', self._on_notify_title)
+
+    def close(self):
+        """
+        Stop relaying for the view, dropping anything not yet delivered.
+        """
+        self._view.disconnect(self._title_id)
+        if self._flush_id is not None:
+            GLib.source_remove(self._flush_id)
+            self._flush_id = None
+        if self._pump_id is not None:
+            GLib.source_remove(self._pump_id)
+            self._pump_id = None
+        self._queue = []
+        self._outgoing.clear()
 
     def _on_notify_title(self, view, notify):
         title = view.get_property('title')
@@ -200,17 +407,480 @@ class Hub(GObject.GObject):
             return
         if not isinstance(obj, dict):
             return
-        self.emit(obj['signal'], *obj['args'])
+        if 'batch' in obj:
+            self._recv_batch(obj['session'], obj['batch'])
+        else:
+            self._receive(obj['signal'], obj['args'])
+
+    def _receive(self, signal, args):
+        # A signal sent from JavaScript, relay it to the other pages (if any):
+        self.emit(signal, *args)
+        if self.bus is not None:
+            self.bus.relay(self, signal, args)
+
+    def _recv_batch(self, session, batch):
+        """
+        Emit each new message in *batch*, then acknowledge them to JavaScript.
+
+        JavaScript keeps re-sending messages until they are acknowledged, so a
+        batch can contain messages that were already emitted; these are
+        skipped using the ``i`` sequence number.  A jump in the sequence number
+        means messages were lost, which is logged and counted in `Hub.gaps`.
+
+        Large messages arrive as several ``chunk`` messages, which are
+        reassembled before the signal is emitted.
+        """
+        if session != self._session:
+            # New page load, sequence numbers start over:
+            self._session = session
+            self._last_i = -1
+            self._chunks = []
+        last_i = self._last_i
+        for msg in batch:
+            i = msg['i']
+            if i <= self._last_i:
+                continue
+            if i != self._last_i + 1:
+                self.gaps += 1
+                self._chunks = []
+                log.warning('Hub: expected message %d, got %d',
+                    self._last_i + 1, i
+                )
+            self._last_i = i
+            if 'chunk' in msg:
+                self._chunks.append(msg['chunk'])
+                if msg['more']:
+                    continue
+                obj = json.loads(''.join(self._chunks))
+                self._chunks = []
+            else:
+                obj = msg
+            self._receive(obj['signal'], obj['args'])
+        if self._last_i != last_i:
+            self._view.execute_script('Hub.ack({})'.format(self._last_i))
 
     def send(self, signal, *args):
         """
         Emit a signal by calling the JavaScript Signal.recv() function.
+
+        When the hub was created with ``batch=True``, the message is queued and
+        all messages sent during the current main loop iteration are delivered
+        in order with a single call to the JavaScript Hub.recv_batch()
+        function.  Use `Hub.flush()` to deliver queued messages right away.
+
+        Messages larger than *chunk_size* are split into chunks that are
+        delivered across several main loop iterations, so neither WebKit nor
+        Gtk has to evaluate one giant script.
+        """
+        data = json.dumps({'signal': signal, 'args': args}, sort_keys=True)
+        self.deliver(data)
+        self.emit(signal, *args)
+
+    def deliver(self, data):
+        """
+        Deliver an already serialized message to JavaScript only.
         """
-        script = 'Hub.recv({!r})'.format(
-            json.dumps({'signal': signal, 'args': args}, sort_keys=True)
+        if len(data) > self._chunk_size:
+            self._flush_queue()
+            self._transfers += 1
+            self._push(self._iter_chunk_scripts(self._transfers, data))
+        elif self._batch:
+            self._queue.append(data)
+            if self._flush_id is None:
+                self._flush_id = GLib.idle_add(self._on_idle_flush)
+        else:
+            self._execute('Hub.recv({!r})'.format(data))
+
+    def flush(self):
+        """
+        Deliver any queued messages and pending chunks to JavaScript now.
+        """
+        self._flush_queue()
+        if self._pump_id is not None:
+            GLib.source_remove(self._pump_id)
+            self._pump_id = None
+        while self._outgoing:
+            self._execute_next()
+
+    def _flush_queue(self):
+        if self._flush_id is not None:
+            GLib.source_remove(self._flush_id)
+            self._flush_id = None
+        if not self._queue:
+            return
+        script = 'Hub.recv_batch({!r})'.format(
+            '[' + ', '.join(self._queue) + ']'
         )
+        self._queue = []
+        self._execute(script)
+
+    def _on_idle_flush(self):
+        self._flush_id = None
+        self._flush_queue()
+        return False
+
+    def _iter_chunk_scripts(self, transfer, data):
+        for (chunk, more) in iter_chunks(data, self._chunk_size):
+            yield 'Hub.recv_chunk({}, {!r}, {})'.format(
+                transfer, chunk, ('true' if more else 'false')
+            )
+
+    def _execute(self, script):
+        # Keep ordering when chunks from an earlier message are still pending:
+        if self._outgoing:
+            self._push(script)
+        else:
+            self._view.execute_script(script)
+
+    def _push(self, item):
+        self._outgoing.append(item)
+        if self._pump_id is None:
+            self._pump_id = GLib.idle_add(self._on_pump)
+
+    def _execute_next(self):
+        item = self._outgoing[0]
+        if isinstance(item, str):
+            script = self._outgoing.popleft()
+        else:
+            try:
+                script = next(item)
+            except StopIteration:
+                self._outgoing.popleft()
+                return 0
         self._view.execute_script(script)
-        self.emit(signal, *args)        
+        return len(script)
+
+    def _on_pump(self):
+        # Execute at most about chunk_size bytes of script per iteration:
+        size = 0
+        while self._outgoing and size < self._chunk_size:
+            size += self._execute_next()
+        if self._outgoing:
+            return True
+        self._pump_id = None
+        return False
+
+
+class ResourceTimings:
+    """
+    Per-resource load timings recorded by `CouchView.enable_timings()`.
+
+    Each resource is tracked from ``resource-request-starting`` until it
+    finished or failed loading.  The last *size* records are kept in a ring
+    buffer, along with counts by scheme and host.  Each record includes
+    *handler*, the seconds spent in `CouchView._on_request()` itself (Dmedia
+    resolution, OAuth signing, etc.), and *final_uri*, the URI after it.
+    """
+
+    def __init__(self, size=500):
+        self.size = size
+        self.records = deque(maxlen=size)
+        self.pending = OrderedDict()
+        self.schemes = {}
+        self.hosts = {}
+        self.handler = 0.0
+        self.dropped = 0
+
+    def start(self, key, uri, final_uri, handler):
+        u = urlparse(uri)
+        self.schemes[u.scheme] = self.schemes.get(u.scheme, 0) + 1
+        if u.netloc:
+            self.hosts[u.netloc] = self.hosts.get(u.netloc, 0) + 1
+        self.handler += handler
+        self.pending[key] = {
+            'uri': uri,
+            'final_uri': final_uri,
+            'start': time.monotonic(),
+            'handler': handler,
+            'duration': None,
+            'status': 'pending',
+        }
+        # Resources served from the memory cache never finish:
+        while len(self.pending) > self.size:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+
+    def finish(self, key, status='finished'):
+        record = self.pending.pop(key, None)
+        if record is None:
+            return
+        record['duration'] = time.monotonic() - record['start']
+        record['status'] = status
+        self.records.append(record)
+
+    def export(self):
+        """
+        Return a JSON-serializable summary and the recorded resources.
+        """
+        return {
+            'resources': list(self.records),
+            'pending': len(self.pending),
+            'dropped': self.dropped,
+            'by_scheme': dict(self.schemes),
+            'by_host': dict(self.hosts),
+            'handler': self.handler,
+        }
+
+    def to_json(self):
+        return json.dumps(self.export(), indent=4, sort_keys=True)
+
+
+class HubBus(GObject.GObject):
+    """
+    Relay Hub signals among the pages in all the views of an app.
+
+    There is one `Hub` per view, created by `HubBus.add()`.  `HubBus.send()`
+    delivers a message to every page and then emits it locally, just like
+    `Hub.send()` does for a single page.  A signal sent from any page is
+    emitted on the bus and delivered to all the other pages.
+    """
+
+    def __init__(self, hub_class=Hub, batch=False, chunk_size=CHUNK_SIZE):
+        super().__init__()
+        self._hub_class = hub_class
+        self._batch = batch
+        self._chunk_size = chunk_size
+        self.hubs = []
+
+    def add(self, view):
+        hub = self._hub_class(view, self._batch, self._chunk_size)
+        hub.bus = self
+        self.hubs.append(hub)
+        return hub
+
+    def remove(self, hub):
+        hub.close()
+        hub.bus = None
+        self.hubs.remove(hub)
+
+    def send(self, signal, *args):
+        # Serialize once no matter how many pages there are:
+        data = json.dumps({'signal': signal, 'args': args}, sort_keys=True)
+        for hub in self.hubs:
+            hub.deliver(data)
+        self.emit(signal, *args)
+
+    def flush(self):
+        for hub in self.hubs:
+            hub.flush()
+
+    def relay(self, source, signal, args):
+        """
+        Called by *source* `Hub` when its page sent *signal*.
+        """
+        others = [hub for hub in self.hubs if hub is not source]
+        if others:
+            data = json.dumps({'signal': signal, 'args': args}, sort_keys=True)
+            for hub in others:
+                hub.deliver(data)
+        self.emit(signal, *args)
+
+
+def iter_changes(fp):
+    """
+    Yield each row from the continuous ``_changes`` response *fp*.
+
+    Blank heartbeat lines are skipped.  For example:
+
+    >>> from io import BytesIO
+    >>> fp = BytesIO(b'{"seq": 1, "id": "foo"}\\n\\n{"last_seq": 1}\\n')
+    >>> list(iter_changes(fp))
+    [{'seq': 1, 'id': 'foo'}, {'last_seq': 1}]
+
+    """
+    while True:
+        line = fp.readline()
+        if not line:
+            break
+        line = line.strip()
+        if line:
+            yield json.loads(line.decode('utf-8'))
+
+
+def is_relevant(row):
+    """
+    Return True if the change in *row* should be sent to pages.
+
+    Design docs and other special docs aren't:
+
+    >>> is_relevant({'id': 'foo', 'seq': 1})
+    True
+    >>> is_relevant({'id': '_design/foo', 'seq': 2})
+    False
+
+    """
+    return not row['id'].startswith('_')
+
+
+class ChangesFeed:
+    """
+    Follow the continuous ``_changes`` feed of *db* in a worker thread.
+
+    Rows are decoded in the worker thread, and only those accepted by
+    *relevant* are passed to *callback* from the main loop, in one batch per
+    main loop iteration holding just the latest change to each document.  For
+    example, *callback* might get called with:
+
+        {'last_seq': 5, 'results': [{'seq': 5, 'id': 'foo', 'doc': {...}}]}
+
+    After an error (or if CouchDB ends the feed), the feed reconnects from the
+    last seq it saw after *retry* seconds.  A connection that goes *timeout*
+    seconds without even a heartbeat is treated as dead, and likewise
+    reconnected.
+    """
+
+    retry = 5  # Seconds to wait before reconnecting after an error
+    heartbeat = 10000  # Milliseconds between heartbeats from CouchDB
+    timeout = 30  # Seconds without data (3 missed heartbeats) before reconnect
+
+    def __init__(self, db, callback, since='now', relevant=is_relevant):
+        self.db = db
+        self.callback = callback
+        self.since = since
+        self.relevant = relevant
+        self.stopped = False
+        self.batches = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._rows = OrderedDict()
+        self._idle_id = None
+        self._thread = None
+        self._sock = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop following, interrupting the worker if it's waiting on CouchDB.
+        """
+        self.stopped = True
+        self._stop.set()
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def open(self):
+        """
+        Return the continuous feed response, starting at `ChangesFeed.since`.
+
+        Called in the worker thread.
+        """
+        options = {
+            'feed': 'continuous',
+            'heartbeat': self.heartbeat,
+            'include_docs': True,
+            'since': self.since,
+        }
+        response = self.db._request('GET', ('_changes',), options)
+        # Otherwise readline() would block forever on a dead connection:
+        self._sock = self.db.ctx.get_connection().sock
+        self._sock.settimeout(self.timeout)
+        return response
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.follow(self.open())
+            except socket.timeout:
+                log.warning('No changes feed heartbeat for %ds, reconnecting',
+                    self.timeout
+                )
+            except Exception as e:
+                log.warning('Changes feed error, retrying in %ds: %r',
+                    self.retry, e
+                )
+            finally:
+                self._sock = None
+                # A partially read response can't be reused:
+                release = getattr(self.db.ctx, 'release', None)
+                if release is not None:
+                    release(discard=True)
+            self._stop.wait(self.retry)
+
+    def follow(self, response):
+        """
+        Queue the rows from *response* for delivery to the main loop.
+        """
+        for row in iter_changes(response):
+            if self._stop.is_set():
+                break
+            if 'last_seq' in row:
+                self.since = row['last_seq']
+                break
+            self.since = row['seq']
+            if self.relevant(row):
+                self.add(row)
+
+    def add(self, row):
+        with self._lock:
+            # Only the latest change to each doc, in seq order:
+            self._rows.pop(row['id'], None)
+            self._rows[row['id']] = row
+            if self._idle_id is None:
+                self._idle_id = GLib.idle_add(self._on_idle)
+
+    def _on_idle(self):
+        with self._lock:
+            self._idle_id = None
+            rows = list(self._rows.values())
+            self._rows.clear()
+        if rows and not self.stopped:
+            self.batches += 1
+            self.callback({'last_seq': rows[-1]['seq'], 'results': rows})
+        return False
+
+
+def percentile(values, p):
+    """
+    Return the *p*-th percentile of *values* using the nearest-rank method.
+
+    For example:
+
+    >>> percentile([0.3, 0.1, 0.2, 0.4], 50)
+    0.2
+    >>> percentile([0.3, 0.1, 0.2, 0.4], 90)
+    0.4
+
+    """
+    ordered = sorted(values)
+    rank = max(1, -(-p * len(ordered) // 100))
+    return ordered[rank - 1]
+
+
+def benchmark_report(runs):
+    """
+    Build a JSON-serializable startup benchmark report from *runs*.
+
+    Each run is a list of ``(phase, seconds)`` pairs as recorded by
+    `BaseApp.mark()`.  For example:
+
+    >>> report = benchmark_report([[('parse', 0.25)], [('parse', 0.5)]])
+    >>> report['phases']['parse']
+    {'min': 0.25, 'p50': 0.25, 'p90': 0.5, 'p99': 0.5, 'max': 0.5}
+
+    """
+    phases = OrderedDict()
+    for run in runs:
+        for (name, seconds) in run:
+            phases.setdefault(name, []).append(seconds)
+    return {
+        'runs': [dict(run) for run in runs],
+        'phases': OrderedDict(
+            (name, {
+                'min': min(values),
+                'p50': percentile(values, 50),
+                'p90': percentile(values, 90),
+                'p99': percentile(values, 99),
+                'max': max(values),
+            })
+            for (name, values) in phases.items()
+        ),
+    }
 
 
 def iter_gsignals(signals):
@@ -221,17 +891,18 @@ def iter_gsignals(signals):
         yield (name, (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE, args))
 
 
-def hub_factory(signals):
+def hub_factory(signals, base=Hub):
     if signals:
-        class FactoryHub(Hub):
+        class FactoryHub(base):
             __gsignals__ = dict(iter_gsignals(signals))
         return FactoryHub
-    return Hub
+    return base
 
 
 class BaseApp:
     name = 'userwebkit'  # The namespace of your app, likely source package name
     dbname = 'userwebkit-0'  # Main CouchDB database name
+    databases = None  # {dbname: [design_doc, ...]}, see iter_databases()
     version = None  # Your app version, eg '12.04.0'
     title = 'App Window Title'  # Default Gtk.Window title
     page = 'index.html'  # Default page to load once CouchDB is available
@@ -240,9 +911,17 @@ class BaseApp:
     enable_logging = True  # If True, send console message to Python logging
 
     dmedia_resolver = None  # Callback to resolve Dmedia URIs
+    dmedia_resolve_many = None  # Optional callback to resolve many at once
 
     proxy_bus = 'org.freedesktop.DC3'  # Dbus service that will start CouchDB
     proxy_path = '/'
+    cache_env = True  # If True, start with the last env while DBus catches up
+    serve_assets = False  # If True, load JS, CSS, etc. directly from self.ui
+    background_workers = 4  # Threads used by BaseApp.run_in_background()
+    max_connections = 5  # Max keep-alive connections to CouchDB
+    prewarm_views = 0  # Number of CouchView instances to build ahead of time
+    follow_changes = False  # If True, push main db changes to pages via hub
+    enable_timings = False  # If True, record per-resource load timings
 
     width = 960  # Default Gtk.Window width
     height = 540  # Default Gtk.Window height
@@ -251,6 +930,8 @@ class BaseApp:
     decorated = True  # If False, call window.set_decorated(False)
 
     signals = None
+    hub_batch = False  # If True, batch Hub.send() calls per main loop iteration
+    hub_chunk_size = CHUNK_SIZE  # Send larger Hub messages in chunks
 
     # Methods that subclasses likely want to override, in order they're called:
     def extend_parser(self, parser):
@@ -262,12 +943,14 @@ class BaseApp:
     def connect_hub_signals(self, hub):
         """
         Called from BaseApp.run(), after BaseApp.build_window().
+
+        The *hub* is a `HubBus` shared by the pages in all windows.
         """
         pass
 
     def get_env(self):
         """
-        Called from BaseApp.on_idle() to get the CouchDB *env*.
+        Called from BaseApp.request_env() to get the CouchDB *env*.
 
         This method should return a Microfiber-style description of the CouchDB
         (or similar) configuration environment that UserWebKit will use to make
@@ -279,20 +962,24 @@ class BaseApp:
         service like Dmedia.  This way you can, for example, directly start a
         UserCouch instance from your main application process when that makes
         more sense.
+
+        When not overridden, BaseApp.request_env() doesn't call this method
+        and instead makes the same DBus call asynchronously.
         """
+        import dbus
         session = dbus.SessionBus()
         self.proxy = session.get_object(self.proxy_bus, self.proxy_path)
         return json.loads(self.proxy.GetEnv())
 
     def post_env_init(self):
         """
-        Called from BaseApp.on_proxy(), right after BaseApp.set_env().
+        Called from BaseApp.on_env(), right after the first BaseApp.set_env().
         """
         pass
 
     def choose_starting_page(self):
         """
-        Called from BaseApp.get_page(), which is called from BaseApp.on_proxy().
+        Called from BaseApp.get_page(), which is called from BaseApp.on_env().
         """
         return self.page
 
@@ -300,8 +987,17 @@ class BaseApp:
         pass
 
     def __init__(self):
+        self.start = time.monotonic()
+        self.timings = []
         self.env = None
+        self.env_cached = False  # True until DBus confirms a cached env
         self.inspector = None
+        self.loaded_page = None
+        self._executor = None
+        self.ctx = None
+        self.views = None
+        self.windows = []
+        self.changes = None
 
         # Figure out if we're running in-tree or not        
         script = path.abspath(sys.argv[0])
@@ -312,6 +1008,7 @@ class BaseApp:
         self.ui = (ui if self.intree else path.join(APPS, self.name))
 
     def parse(self):
+        import optparse
         parser = optparse.OptionParser(
             version=self.version,
         )
@@ -320,13 +1017,25 @@ class BaseApp:
             action='store_true',
             default=False,
         )
+        parser.add_option('--benchmark-runs',
+            help='with --benchmark, number of cold starts to time',
+            metavar='N',
+            type='int',
+            default=1,
+        )
+        parser.add_option('--benchmark-report',
+            help='with --benchmark, write JSON report to FILE',
+            metavar='FILE',
+        )
         parser.add_option('--page',
             help='force UI to load specific HTML5 page, eg "foo.html"',
         )
         self.extend_parser(parser)
         (self.options, self.args) = parser.parse_args()
+        self.mark('parse')
 
     def build_window(self):
+        from gi.repository import Gtk
         self.window = Gtk.Window()
         self.window.connect('destroy', self.quit)
         if self.maximize:
@@ -351,56 +1060,429 @@ class BaseApp:
         return self.choose_starting_page()
 
     def run(self):
+        from gi.repository import Gtk
+        init()
         self.parse()
+        if self.options.benchmark and self.options.benchmark_runs > 1:
+            self.run_benchmark()
+            return
         self.build_window()
+        self.mark('build_window')
         self.window.show_all()
+        self.mark('show_all')
         GLib.idle_add(self.on_idle)
         Gtk.main()
+        if self.options.benchmark:
+            self.write_report(benchmark_report([self.timings]))
+
+    def mark(self, phase):
+        """
+        Record that startup *phase* just finished.
+
+        Timestamps are in seconds since this `BaseApp` was created.
+        """
+        self.timings.append((phase, time.monotonic() - self.start))
+
+    def run_benchmark(self):
+        """
+        Time ``--benchmark-runs`` cold starts, each in a new process.
+        """
+        import subprocess
+        import tempfile
+        runs = []
+        for i in range(self.options.benchmark_runs):
+            with tempfile.NamedTemporaryFile(suffix='.json') as tmp:
+                cmd = [
+                    sys.executable, path.abspath(sys.argv[0]),
+                    '--benchmark', '--benchmark-report', tmp.name,
+                ]
+                if self.options.page:
+                    cmd.extend(['--page', self.options.page])
+                subprocess.check_call(cmd)
+                run = json.load(open(tmp.name, 'r'))['runs'][0]
+            runs.append(list(run.items()))
+        self.write_report(benchmark_report(runs))
+
+    def write_report(self, report):
+        data = json.dumps(report, indent=4)
+        if self.options.benchmark_report:
+            with open(self.options.benchmark_report, 'w') as fp:
+                fp.write(data)
+        else:
+            print(data)
 
     def quit(self, *arg):
         # FIXME: This is a work-around for the segfault we're getting when
         # The window is destroyed before the inspector is
+        from gi.repository import Gtk
         if self.inspector:
             self.inspector.destroy()
+        if self.changes is not None:
+            self.changes.stop()
+            self.changes = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self.ctx is not None:
+            self.ctx.close()
         Gtk.main_quit()
 
+    def run_in_background(self, func, *args, callback=None,
+            error_callback=None):
+        """
+        Call ``func(*args)`` in a worker thread, return a `BackgroundTask`.
+
+        Use this for anything that would otherwise block the main loop.  The
+        *callback* (or *error_callback*) is called from the main loop.  For
+        example:
+
+        >>> app = BaseApp()
+        >>> task = app.run_in_background(sum, [1, 2, 3], callback=print)
+        >>> task.wait()
+        True
+
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.background_workers)
+        task = BackgroundTask(func, args, callback, error_callback)
+        task.future = self._executor.submit(self._run_task, task)
+        return task
+
+    def _run_task(self, task):
+        try:
+            task.run()
+        finally:
+            # Return this worker's CouchDB connections to their pools, even
+            # one from a context set_env() has since replaced:
+            if self.ctx is not None:
+                from userwebkit.pool import release_all
+                release_all()
+
     def on_idle(self):
-        if self.options.benchmark:
-            Gtk.main_quit()
-            return
+        from userwebkit.view import ViewPool
 
-        # Add the CouchView
-        self.view = CouchView(None, self.dmedia_resolver)
-        self.view.connect('open', self.on_open)
-        self.scroll.add(self.view)
+        # Add the CouchView, the pool pre-builds more if prewarm_views > 0:
+        self.views = ViewPool(self.prewarm_views, self.setup_view,
+            self.dmedia_resolver, self.dmedia_resolve_many,
+            background=self.run_in_background,
+        )
+        self.view = self.views.get()
         if self.enable_inspector:
-            self.view.get_settings().set_property('enable-developer-extras', True)
+            # Only the main view gets the inspector, it packs into self.vpaned:
+            self.view.get_settings().set_property(
+                'enable-developer-extras', True
+            )
             inspector = self.view.get_inspector()
             inspector.connect('inspect-web-view', self.on_inspect)
-        if self.enable_logging:
-            self.view.enable_logging()
+        self.scroll.add(self.view)
+        if self.options.benchmark:
+            self.view.connect('notify::load-status', self.on_load_status)
         self.view.show()
 
-        # Create the hub
-        self.hub = hub_factory(self.signals)(self.view)
+        # Create the hub, shared by the pages in all windows:
+        signals = dict(self.signals or {})
+        if self.follow_changes:
+            signals['changes'] = ['dbname', 'result']
+        self.hub = hub_factory(signals, HubBus)(hub_factory(signals),
+            self.hub_batch, self.hub_chunk_size
+        )
+        self.hub.add(self.view)
         self.connect_hub_signals(self.hub)
         
-        self.set_env(self.get_env())
+        cached = (self.load_env_cache() if self.cache_env else None)
+        self.request_env()
+        if cached is not None and self.env is None:
+            self.on_env(cached, cached=True)
+
+    def setup_view(self, view):
+        """
+        Called by the `ViewPool` for each new `CouchView`.
+        """
+        view.connect('open', self.on_open)
+        if self.enable_logging:
+            view.enable_logging()
+        if self.enable_timings:
+            view.enable_timings()
+
+    def request_env(self):
+        """
+        Get the CouchDB *env* without blocking the main loop.
+
+        BaseApp.on_env() is called once the *env* is available.  If a subclass
+        overrides BaseApp.get_env(), it's called in a worker thread instead.
+        """
+        if type(self).get_env is not BaseApp.get_env:
+            self.run_in_background(self.get_env,
+                callback=self.on_env, error_callback=self.on_env_error
+            )
+            return
+        import dbus
+        session = dbus.SessionBus()
+        # follow_name_owner_changes=True skips the blocking service activation
+        # in ProxyObject.__init__(), GetEnv() still starts the service:
+        self.proxy = session.get_object(
+            self.proxy_bus, self.proxy_path, introspect=False,
+            follow_name_owner_changes=True,
+        )
+        self.proxy.GetEnv(
+            reply_handler=self.on_env_reply,
+            error_handler=self.on_env_error,
+        )
+
+    def on_env_reply(self, data):
+        self.on_env(json.loads(data))
+
+    def on_env_error(self, error):
+        log.error('Could not get env from %s: %s', self.proxy_bus, error)
+
+    def on_env(self, env, cached=False):
+        """
+        Use *env*, loading the starting page the first time an env is set.
+
+        When *cached* is True, *env* came from the on-disk cache and might be
+        stale, in which case it's ignored until the real env arrives.  When the
+        real env differs from the cached one, the page is reloaded.
+
+        The database is ensured in the background, and the page is only loaded
+        once that has succeeded, see BaseApp.on_env_ready().
+        """
+        if not cached:
+            self.mark('get_env')
+            if self.cache_env:
+                self.save_env_cache(env)
+        if env == self.env:
+            if not cached:
+                # Confirmed, even if the cached env is still being ensured:
+                self.env_cached = False
+            return
+        self.set_env(env)
+        self.env_cached = cached
+        self.mark('set_env')
+        self.ensure_databases(env, cached)
+
+    def iter_databases(self):
+        """
+        Yield ``(dbname, designs)`` for each database this app uses.
+
+        The main database is always first, followed by any others from
+        `BaseApp.databases`, which maps database names to a list of design
+        docs.  For example:
+
+        >>> app = BaseApp()
+        >>> app.databases = {
+        ...     'foo-0': [],
+        ...     'userwebkit-0': [{'_id': '_design/bar', 'views': {}}],
+        ... }
+        >>> list(app.iter_databases())
+        [('userwebkit-0', [{'_id': '_design/bar', 'views': {}}]), ('foo-0', [])]
+
+        """
+        databases = (self.databases or {})
+        yield (self.dbname, databases.get(self.dbname, []))
+        for name in sorted(databases):
+            if name != self.dbname:
+                yield (name, databases[name])
+
+    def ensure_databases(self, env, cached=False):
+        """
+        Concurrently ensure each database and sync its design docs.
+
+        BaseApp.on_env_ready() is called once all databases are ready.
+        """
+        pending = set(self.dbs)
+        for (name, designs) in self.iter_databases():
+            self.run_in_background(ensure_database, self.dbs[name], designs,
+                callback=partial(self.on_db_ready, env, pending, name),
+                error_callback=partial(self.on_env_failed, env, cached,
+                    pending
+                ),
+            )
+
+    def on_db_ready(self, env, pending, name, saved):
+        if saved:
+            log.info('Updated design docs in %r: %r', name, saved)
+        pending.discard(name)
+        if not pending:
+            self.on_env_ready(env, None)
+
+    def on_env_failed(self, env, cached, pending, error):
+        if env is not self.env or None in pending:
+            return  # A newer env has been set, or another database failed
+        pending.add(None)  # So on_env_ready() is never called for this try
+        if self.env_cached:
+            log.warning('Cached env is stale, waiting for %s', self.proxy_bus)
+            self.env = None
+            self.env_cached = False
+        elif cached:
+            # DBus confirmed the cached env while it was being ensured:
+            log.warning('Could not ensure databases, retrying: %r', error)
+            self.ensure_databases(env)
+        else:
+            log.error('Could not ensure databases: %r', error)
+
+    def on_env_ready(self, env, result):
+        """
+        Called once the databases for *env* have been ensured.
+        """
+        if env is not self.env:
+            return  # A newer env has already been set
+        self.mark('db.ensure')
+        if self.follow_changes:
+            self.follow(self.db)
+        if self.loaded_page is not None:
+            self.load_page(self.loaded_page)
+            for window in self.windows:
+                self.load_window_page(window)
+            return
         self.post_env_init()
         page = self.get_page()
         self.load_page(page)
+        self.loaded_page = page
+        self.mark('load_page')
+        for window in self.windows:
+            self.load_window_page(window)
         self.post_page_init(page)
 
+    def follow(self, db):
+        """
+        Push changes in *db* to all pages as a ``changes`` hub signal.
+
+        Only a single upstream ``_changes`` feed is followed no matter how
+        many windows are open.  A ``couch.Session`` created with the hub gets
+        its changes from this signal instead of polling, for example:
+
+            var session = new couch.Session(db, callback, Hub);
+        """
+        if self.changes is not None:
+            self.changes.stop()
+        self.changes = ChangesFeed(db, partial(self.on_changes, db.name),
+            relevant=self.is_relevant_change
+        )
+        self.changes.start()
+
+    def is_relevant_change(self, row):
+        """
+        Return True if the change in *row* should be pushed to pages.
+
+        Called in a worker thread; subclasses can override this to push fewer
+        documents.
+        """
+        return is_relevant(row)
+
+    def on_changes(self, dbname, result):
+        self.hub.send('changes', dbname, result)
+
+    def open_window(self, page=None):
+        """
+        Open another window showing *page*, return the new `AppWindow`.
+
+        The window shares this app's env, `HubBus` and changes feed.  If
+        *page* is None, the page from BaseApp.get_page() is used.
+        """
+        from userwebkit.view import AppWindow
+        window = AppWindow(self.views.get(), self.title, self.width,
+            self.height
+        )
+        window.page = (self.get_page() if page is None else page)
+        window.hub = self.hub.add(window.view)
+        window.connect('destroy', self.on_window_destroy)
+        self.windows.append(window)
+        window.show_all()
+        if self.loaded_page is not None:
+            self.load_window_page(window)
+        return window
+
+    def load_window_page(self, window):
+        url = self.server.ctx.full_url(self.get_path(window.page))
+        window.view.load_uri(url)
+
+    def on_window_destroy(self, window):
+        self.hub.remove(window.hub)
+        self.windows.remove(window)
+        # Give the view back to the ViewPool for reuse:
+        window.scroll.remove(window.view)
+        self.views.release(window.view)
+
+    def get_env_cache_filename(self):
+        return path.join(GLib.get_user_cache_dir(), self.name, 'env.json')
+
+    def load_env_cache(self):
+        """
+        Return the env saved by BaseApp.save_env_cache(), or None.
+        """
+        try:
+            with open(self.get_env_cache_filename(), 'r') as fp:
+                env = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if isinstance(env, dict) and 'url' in env:
+            return env
+
+    def save_env_cache(self, env):
+        """
+        Save *env* for the next start.
+
+        As the env contains credentials, the file is only readable by the user.
+        """
+        filename = self.get_env_cache_filename()
+        try:
+            os.makedirs(path.dirname(filename), exist_ok=True)
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, 'w') as fp:
+                json.dump(env, fp)
+        except OSError:
+            log.exception('Could not save env cache %r', filename)
+
+    def on_load_status(self, view, notify):
+        from gi.repository import Gtk, WebKit
+        status = view.get_property('load-status')
+        if status == WebKit.LoadStatus.FIRST_VISUALLY_NON_EMPTY_LAYOUT:
+            self.mark('first_paint')
+        elif status == WebKit.LoadStatus.FINISHED:
+            self.mark('load_finished')
+            Gtk.main_quit()
+        elif status == WebKit.LoadStatus.FAILED:
+            self.mark('load_failed')
+            Gtk.main_quit()
+
     def set_env(self, env):    
+        """
+        Use *env* for all CouchDB access from this app and its views.
+
+        All Python-side CouchDB access should go through `BaseApp.server` (or
+        databases from `BaseApp.server.database()`), which share a pool of at
+        most `BaseApp.max_connections` keep-alive connections.  The pool
+        always has room for every background worker and the changes feed,
+        plus one spare; the main loop uses its own dedicated connection.
+        """
+        import microfiber
+        from userwebkit.pool import PooledContext
+        if self.ctx is not None:
+            self.ctx.close()
         self.env = env
-        self.server = microfiber.Server(env)
-        self.db = microfiber.Database(self.dbname, env) 
-        self.db.ensure()
+        size = max(self.max_connections, self.background_workers + 2)
+        self.ctx = PooledContext(env, size)
+        self.server = microfiber.Server(self.ctx)
+        self.dbs = OrderedDict(
+            (name, self.server.database(name))
+            for (name, designs) in self.iter_databases()
+        )
+        self.db = self.dbs[self.dbname]
 #        if self.intree:
 #            self.server.put(
 #                handler(self.ui), '_config', 'httpd_global_handlers', '_intree'
 #            )
         self.view.set_env(env)
+        if self.serve_assets:
+            self.view.set_assets(self.get_path(''), self.ui)
+        if self.views is not None:
+            self.views.set_env(env)
+            if self.serve_assets:
+                self.views.set_assets(self.get_path(''), self.ui)
+        for window in self.windows:
+            window.view.set_env(env)
+            if self.serve_assets:
+                window.view.set_assets(self.get_path(''), self.ui)
         if self.inspector is not None:
             self.inspector.view.set_env(env)
 
@@ -441,15 +1523,26 @@ class BaseApp:
         self.view.load_uri(self.server.ctx.full_url(self.get_path(page)))
 
     def on_inspect(self, *args):
-        self.inspector = Inspector(self.env)
+        from userwebkit.view import Inspector
+        if self.inspector is not None:
+            # Already open, there's only room for one in self.vpaned:
+            return self.inspector.view
+        self.inspector = Inspector(self.env, self.views.get(),
+            self.view.timings
+        )
         pos = self.window.get_allocated_height() * 2 // 3
         self.vpaned.set_position(pos)
         self.vpaned.pack2(self.inspector, True, True)
         self.inspector.show_all()
         self.inspector.reload.connect('clicked', self.on_reload)
         self.inspector.futon.connect('clicked', self.on_futon)
+        self.inspector.connect('destroy', self.on_inspector_destroy)
         return self.inspector.view
 
+    def on_inspector_destroy(self, inspector):
+        if self.inspector is inspector:
+            self.inspector = None
+
     def on_reload(self, button):
         self.view.reload_bypass_cache()
 
@@ -458,6 +1551,8 @@ class BaseApp:
 
     def on_open(self, view, uri):
         import subprocess
-        subprocess.check_call(['/usr/bin/xdg-open', uri])
+        self.run_in_background(
+            subprocess.check_call, ['/usr/bin/xdg-open', uri]
+        )
 
 
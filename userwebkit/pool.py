@@ -0,0 +1,198 @@
+# userwebkit: so WebKitGtk apps can to talk to a usercouch
+# Copyright (C) 2016 Novacut Inc
+#
+# This file is part of `userwebkit`.
+#
+# `userwebkit` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# `userwebkit` is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with `userwebkit`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+Keep-alive HTTP connection pool shared by all Python-side CouchDB access.
+"""
+
+import time
+import threading
+
+import microfiber
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of persistent connections made by calling *connect*.
+
+    At most *size* connections are checked out at once; further checkouts
+    block until one is checked back in.  Connections that have been idle for
+    longer than *idle_timeout* seconds are closed.
+    """
+
+    def __init__(self, connect, size=5, idle_timeout=30):
+        self.connect = connect
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self.closed = False
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def checkout(self, timeout=None):
+        """
+        Return an idle connection, or a new one if none are idle.
+
+        Raises ``TimeoutError`` if no connection became available within
+        *timeout* seconds.
+        """
+        if timeout is None:
+            self._slots.acquire()
+        elif not self._slots.acquire(timeout=timeout):
+            raise TimeoutError(
+                'no connection available after {}s'.format(timeout)
+            )
+        with self._lock:
+            self._evict()
+            if self._idle:
+                (conn, last_used) = self._idle.pop()
+                self.reused += 1
+                return conn
+            self.created += 1
+        try:
+            return self.connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def checkin(self, conn, discard=False):
+        """
+        Return *conn* to the pool, or close it when *discard* is True.
+        """
+        if discard or self.closed:
+            conn.close()
+        else:
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+                self._evict()
+        self._slots.release()
+
+    def _evict(self):
+        # Must be called with self._lock held:
+        cutoff = time.monotonic() - self.idle_timeout
+        keep = []
+        for (conn, last_used) in self._idle:
+            if last_used < cutoff:
+                conn.close()
+                self.evicted += 1
+            else:
+                keep.append((conn, last_used))
+        self._idle = keep
+
+    def close(self):
+        """
+        Close all idle connections, and any checked in later.
+        """
+        with self._lock:
+            self.closed = True
+            for (conn, last_used) in self._idle:
+                conn.close()
+            self._idle = []
+
+    def stats(self):
+        with self._lock:
+            return {
+                'created': self.created,
+                'reused': self.reused,
+                'evicted': self.evicted,
+                'idle': len(self._idle),
+            }
+
+
+_held = threading.local()
+
+
+def release_all(discard=False):
+    """
+    Return every pooled connection held by the current thread.
+
+    `BaseApp.run_in_background()` calls this after each task, so a worker
+    gives back its connection even if `BaseApp.set_env()` replaced the
+    context the task was using.
+    """
+    for ctx in list(getattr(_held, 'contexts', [])):
+        ctx.release(discard)
+
+
+class PooledContext(microfiber.Context):
+    """
+    A ``microfiber.Context`` whose connections come from a `ConnectionPool`.
+
+    Each thread keeps the connection it checked out until it calls
+    `PooledContext.release()`; `BaseApp.run_in_background()` does this after
+    every task, so worker threads share a small set of keep-alive connections.
+
+    The thread that creates the context (normally the one running the Gtk
+    main loop) gets its own dedicated connection instead, so it never waits
+    on the pool.
+    """
+
+    def __init__(self, env, size=5, idle_timeout=30):
+        super().__init__(env)
+        self.pool = ConnectionPool(self.connect, size, idle_timeout)
+        self._local = threading.local()
+        self._owner = threading.get_ident()
+        self._owner_conn = None
+
+    def get_connection(self):
+        if threading.get_ident() == self._owner:
+            if self._owner_conn is None:
+                self._owner_conn = self.connect()
+            return self._owner_conn
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self.pool.checkout()
+            self._local.conn = conn
+            if not hasattr(_held, 'contexts'):
+                _held.contexts = set()
+            _held.contexts.add(self)
+        return conn
+
+    def release(self, discard=False):
+        """
+        Return the current thread's connection, if any, to the pool.
+
+        Use *discard* when the connection might not be reusable, for example
+        when a response wasn't fully read.  The owner thread keeps its
+        dedicated connection unless it's discarded.
+        """
+        if threading.get_ident() == self._owner:
+            if discard and self._owner_conn is not None:
+                self._owner_conn.close()
+                self._owner_conn = None
+            return
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            del self._local.conn
+            getattr(_held, 'contexts', set()).discard(self)
+            self.pool.checkin(conn, discard)
+
+    def close(self):
+        """
+        Close the dedicated connection and all idle pooled connections.
+        """
+        if self._owner_conn is not None:
+            self._owner_conn.close()
+            self._owner_conn = None
+        self.pool.close()
@@ -26,9 +26,14 @@ Unit tests for `userwebkit`.
 from unittest import TestCase
 import os
 from os import path
+from tempfile import TemporaryDirectory
 from base64 import b32encode
 from urllib.parse import urlparse
 from random import SystemRandom
+import threading
+import socket
+import json
+from io import BytesIO
 
 from dbase32 import random_id
 import usercouch
@@ -38,9 +43,11 @@ from microfiber import basic_auth_header
 from gi.repository.GObject import SIGNAL_RUN_LAST, TYPE_NONE, TYPE_PYOBJECT
 
 import userwebkit
+from userwebkit import view as userwebkit_view
+from userwebkit.pool import ConnectionPool, PooledContext, release_all
 
 
-orig_log = userwebkit.log
+orig_log = userwebkit_view.log
 random = SystemRandom()
 
 
@@ -80,6 +87,20 @@ class DummyCallback:
         self._calls.append(args)
 
 
+class DummyHeaders:
+    def __init__(self):
+        self._headers = []
+
+    def append(self, name, value):
+        self._headers.append((name, value))
+
+
+class DummyMessage:
+    def __init__(self, method='GET'):
+        self.method = method
+        self.request_headers = DummyHeaders()
+
+
 class DummyRequest:
     def __init__(self, uri, message = None):
         self.__uri = uri
@@ -116,9 +137,49 @@ class DummyResolver:
         return (_id, 0, filename)
 
 
-class DummyCouchView:
+class DummyResolveMany:
+    def __init__(self):
+        self._calls = []
+
+    def __call__(self, ids):
+        self._calls.append(ids)
+        return [(_id, 3, '') for _id in ids]
+
+
+class DummyBackground:
+    def __init__(self):
+        self._calls = []
+
+    def __call__(self, func, *args, callback=None, error_callback=None):
+        self._calls.append((func, args, callback, error_callback))
+
+
+class DummyConnection:
+    def __init__(self):
+        self._closed = False
+
+    def close(self):
+        self._closed = True
+
+
+class DummyConnect:
     def __init__(self):
+        self._conns = []
+
+    def __call__(self):
+        conn = DummyConnection()
+        self._conns.append(conn)
+        return conn
+
+
+class DummyCouchView:
+    def __init__(self, title=None):
         self._scripts = []
+        self._title = title
+
+    def get_property(self, name):
+        assert name == 'title'
+        return self._title
 
     def set_env(self, env):
         assert not hasattr(self, '_env')
@@ -127,11 +188,64 @@ class DummyCouchView:
     def connect(self, *args):
         assert not hasattr(self, '_connect')
         self._connect = args
+        return 17
+
+    def disconnect(self, handler_id):
+        self._disconnect = handler_id
 
     def execute_script(self, script):
         self._scripts.append(script)
  
 
+def changes_response(rows):
+    lines = [json.dumps(row).encode('utf-8') + b'\n' for row in rows]
+    return BytesIO(b'\n'.join(lines))
+
+
+class DummySocket:
+    def __init__(self):
+        self._timeout = None
+        self._shutdown = None
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def shutdown(self, how):
+        self._shutdown = how
+
+
+class DummySocketConnection:
+    def __init__(self):
+        self.sock = DummySocket()
+
+
+class DummyReleaseContext:
+    def __init__(self):
+        self._released = []
+        self._conn = DummySocketConnection()
+
+    def get_connection(self):
+        return self._conn
+
+    def release(self, discard=False):
+        self._released.append(discard)
+
+
+class DummyChangesDatabase:
+    def __init__(self):
+        self.ctx = DummyReleaseContext()
+        self._calls = []
+        self._feed = None
+
+    def _request(self, method, parts, options):
+        self._calls.append((method, parts, dict(options)))
+        if len(self._calls) == 2:
+            return changes_response([{'seq': 4, 'id': 'foo'}])
+        if len(self._calls) == 3:
+            self._feed.stop()
+        raise ConnectionResetError()
+
+
 class DummyLogger:
     def __init__(self):
         self._messages = []
@@ -156,6 +270,36 @@ class TestConstants(TestCase):
 
 
 class TestFunctions(TestCase):
+    def test_init(self):
+        self.assertIsNone(userwebkit.init())
+        self.assertIs(userwebkit._initialized, True)
+        self.assertIsNone(userwebkit.init())
+        self.assertIs(userwebkit._initialized, True)
+
+    def test_parse_uri(self):
+        userwebkit.parse_uri.cache_clear()
+        self.assertEqual(
+            userwebkit.parse_uri('http://localhost:5984/foo/bar'),
+            ('http://localhost:5984/foo/bar', tuple())
+        )
+        self.assertEqual(
+            userwebkit.parse_uri('https://127.0.0.1:5984/foo/?b=2&a=1'),
+            ('https://127.0.0.1:5984/foo/', (('b', '2'), ('a', '1')))
+        )
+        self.assertEqual(
+            userwebkit.parse_uri('http://localhost:5984/foo?bar'),
+            ('http://localhost:5984/foo', (('bar', ''),))
+        )
+
+        # Repeated URIs should be served from the cache:
+        info = userwebkit.parse_uri.cache_info()
+        self.assertEqual(info.hits, 0)
+        self.assertEqual(info.misses, 3)
+        userwebkit.parse_uri('http://localhost:5984/foo?bar')
+        info = userwebkit.parse_uri.cache_info()
+        self.assertEqual(info.hits, 1)
+        self.assertEqual(info.misses, 3)
+
     def test_iter_gsignals(self):
         self.assertEqual(
             dict(userwebkit.iter_gsignals({})), 
@@ -222,25 +366,811 @@ class TestFunctions(TestCase):
         )
 
 
+    def test_percentile(self):
+        values = [0.1 * i for i in range(1, 101)]
+        random.shuffle(values)
+        self.assertEqual(userwebkit.percentile(values, 50), 0.1 * 50)
+        self.assertEqual(userwebkit.percentile(values, 90), 0.1 * 90)
+        self.assertEqual(userwebkit.percentile(values, 100), 0.1 * 100)
+        self.assertEqual(userwebkit.percentile(values, 0), 0.1)
+        self.assertEqual(userwebkit.percentile([3], 99), 3)
+
+    def test_benchmark_report(self):
+        runs = [
+            [('parse', 0.1), ('get_env', 0.5), ('load_finished', 0.9)],
+            [('parse', 0.2), ('get_env', 0.4)],
+        ]
+        report = userwebkit.benchmark_report(runs)
+        self.assertEqual(report['runs'], [
+            {'parse': 0.1, 'get_env': 0.5, 'load_finished': 0.9},
+            {'parse': 0.2, 'get_env': 0.4},
+        ])
+        self.assertEqual(list(report['phases']),
+            ['parse', 'get_env', 'load_finished']
+        )
+        self.assertEqual(report['phases']['get_env'],
+            {'min': 0.4, 'p50': 0.4, 'p90': 0.5, 'p99': 0.5, 'max': 0.5}
+        )
+        self.assertEqual(report['phases']['load_finished'],
+            {'min': 0.9, 'p50': 0.9, 'p90': 0.9, 'p99': 0.9, 'max': 0.9}
+        )
+        self.assertEqual(json.loads(json.dumps(report))['runs'],
+            report['runs']
+        )
+
+
+    def test_design_hash(self):
+        doc = {'_id': '_design/foo', 'views': {'bar': {'map': 'function'}}}
+        h = userwebkit.design_hash(doc)
+        self.assertEqual(len(h), 40)
+        self.assertEqual(userwebkit.design_hash(dict(doc, _rev='2-abc')), h)
+        self.assertNotEqual(
+            userwebkit.design_hash(dict(doc, views={})), h
+        )
+
+    def test_ensure_database(self):
+        db = DummyDatabase()
+        self.assertEqual(userwebkit.ensure_database(db, []), [])
+        self.assertEqual(db._calls, ['ensure'])
+
+        foo = {'_id': '_design/foo', 'views': {'a': {'map': 'function'}}}
+        bar = {'_id': '_design/bar', 'views': {'b': {'map': 'function'}}}
+        baz = {'_id': '_design/baz', 'views': {}}
+        db = DummyDatabase(docs={
+            '_design/foo': dict(foo, _rev='1-aaa'),
+            '_design/bar': dict(bar, _rev='3-bbb', views={}),
+        })
+        self.assertEqual(userwebkit.ensure_database(db, [foo, bar, baz]),
+            ['_design/bar', '_design/baz']
+        )
+        self.assertEqual(db._calls, [
+            'ensure',
+            ('_all_docs', ['_design/foo', '_design/bar', '_design/baz']),
+            ('save', '_design/bar', '3-bbb'),
+            ('save', '_design/baz', None),
+        ])
+        self.assertNotIn('_rev', bar)
+
+
+    def test_asset_filename(self):
+        d = '/usr/share/couchdb/apps/foo'
+        self.assertEqual(userwebkit.asset_filename(d, 'base.css'),
+            '/usr/share/couchdb/apps/foo/base.css'
+        )
+        self.assertEqual(userwebkit.asset_filename(d, 'a/b/c.PNG#top'),
+            '/usr/share/couchdb/apps/foo/a/b/c.PNG'
+        )
+        self.assertIsNone(userwebkit.asset_filename(d, ''))
+        self.assertIsNone(userwebkit.asset_filename(d, 'foo'))
+        self.assertIsNone(userwebkit.asset_filename(d, 'foo.html'))
+        self.assertIsNone(userwebkit.asset_filename(d, '%2e%2e/foo.js'))
+        self.assertIsNone(userwebkit.asset_filename(d, '../foo2/base.js'))
+
+
+class TestHub(TestCase):
+    def test_init(self):
+        view = DummyCouchView()
+        hub = userwebkit.Hub(view)
+        self.assertIs(hub._view, view)
+        self.assertIs(hub._batch, False)
+        self.assertEqual(hub._queue, [])
+        self.assertIsNone(hub._flush_id)
+        self.assertIsNone(hub._session)
+        self.assertEqual(hub._last_i, -1)
+        self.assertEqual(hub.gaps, 0)
+        self.assertEqual(view._connect,
+            ('notify::title', hub._on_notify_title)
+        )
+
+        self.assertEqual(hub._chunk_size, userwebkit.CHUNK_SIZE)
+        self.assertEqual(len(hub._outgoing), 0)
+        self.assertIsNone(hub._pump_id)
+        self.assertEqual(hub._chunks, [])
+
+        hub = userwebkit.Hub(DummyCouchView(), True, 1024)
+        self.assertIs(hub._batch, True)
+        self.assertEqual(hub._chunk_size, 1024)
+
+    def test_send_chunked(self):
+        signals = {'foo': [], 'bar': ['one']}
+        view = DummyCouchView()
+        hub = userwebkit.hub_factory(signals)(view, False, 40)
+        cb = DummyCallback()
+        hub.connect('bar', cb)
+
+        # Large message is queued as chunks, Python handlers called now:
+        hub.send('bar', 'x' * 60)
+        self.assertEqual(cb._calls, [(hub, 'x' * 60)])
+        self.assertEqual(view._scripts, [])
+        self.assertIsNotNone(hub._pump_id)
+
+        # Later messages must wait behind the pending chunks:
+        hub.send('foo')
+        self.assertEqual(view._scripts, [])
+        self.assertEqual(len(hub._outgoing), 2)
+
+        # Each pump iteration executes about chunk_size bytes of script:
+        data = json.dumps({'args': ['x' * 60], 'signal': 'bar'})
+        chunks = [
+            'Hub.recv_chunk(1, {!r}, {})'.format(
+                chunk, ('true' if more else 'false')
+            )
+            for (chunk, more) in userwebkit.iter_chunks(data, 40)
+        ]
+        self.assertEqual(len(chunks), 3)
+        self.assertIs(hub._on_pump(), True)
+        self.assertEqual(view._scripts, chunks[:1])
+        while hub._on_pump():
+            pass
+        self.assertIsNone(hub._pump_id)
+        self.assertEqual(view._scripts,
+            chunks + ['Hub.recv(\'{"args": [], "signal": "foo"}\')']
+        )
+
+        # Hub.flush() delivers all pending chunks right away:
+        view._scripts = []
+        hub.send('bar', 'y' * 60)
+        hub.flush()
+        self.assertIsNone(hub._pump_id)
+        self.assertEqual(len(hub._outgoing), 0)
+        self.assertEqual(len(view._scripts), 3)
+        self.assertTrue(view._scripts[0].startswith('Hub.recv_chunk(2, '))
+        self.assertTrue(view._scripts[-1].endswith(', false)'))
+
+    def test_send_batch(self):
+        signals = {'foo': [], 'bar': ['one']}
+        view = DummyCouchView()
+        hub = userwebkit.hub_factory(signals)(view, True)
+        cb = DummyCallback()
+        hub.connect('foo', cb)
+        hub.connect('bar', cb)
+
+        # Python handlers are called immediately, JavaScript gets a batch:
+        hub.send('bar', 1)
+        self.assertIsNotNone(hub._flush_id)
+        hub.send('foo')
+        hub.send('bar', 2)
+        self.assertEqual(cb._calls, [(hub, 1), (hub,), (hub, 2)])
+        self.assertEqual(view._scripts, [])
+        self.assertIsNone(hub.flush())
+        self.assertIsNone(hub._flush_id)
+        self.assertEqual(hub._queue, [])
+        self.assertEqual(view._scripts,
+            [
+                'Hub.recv_batch(\'[{"args": [1], "signal": "bar"}, '
+                '{"args": [], "signal": "foo"}, '
+                '{"args": [2], "signal": "bar"}]\')',
+            ]
+        )
+
+        # Nothing is sent when the queue is empty:
+        self.assertIsNone(hub.flush())
+        self.assertEqual(len(view._scripts), 1)
+
+        # Idle callback should flush and remove itself:
+        hub.send('foo')
+        self.assertIs(hub._on_idle_flush(), False)
+        self.assertIsNone(hub._flush_id)
+        self.assertEqual(view._scripts[1],
+            'Hub.recv_batch(\'[{"args": [], "signal": "foo"}]\')'
+        )
+
+
+    def test_on_notify_title(self):
+        signals = {'foo': [], 'bar': ['one']}
+        view = DummyCouchView()
+        hub = userwebkit.hub_factory(signals)(view)
+        cb = DummyCallback()
+        hub.connect('foo', cb)
+        hub.connect('bar', cb)
+
+        # Title that isn't a hub message should be ignored:
+        self.assertIsNone(hub._on_notify_title(view, None))
+        view._title = 'Hello, world'
+        self.assertIsNone(hub._on_notify_title(view, None))
+        view._title = '[1, 2]'
+        self.assertIsNone(hub._on_notify_title(view, None))
+        self.assertEqual(cb._calls, [])
+
+        # Single message as sent by older base.js:
+        view._title = '{"i": 0, "signal": "bar", "args": [17]}'
+        self.assertIsNone(hub._on_notify_title(view, None))
+        self.assertEqual(cb._calls, [(hub, 17)])
+        self.assertEqual(view._scripts, [])
+
+        # Batched messages:
+        cb._calls = []
+        view._title = json.dumps({'session': 'A', 'flush': 1, 'batch': [
+            {'i': 0, 'signal': 'bar', 'args': [1]},
+            {'i': 1, 'signal': 'foo', 'args': []},
+        ]})
+        self.assertIsNone(hub._on_notify_title(view, None))
+        self.assertEqual(cb._calls, [(hub, 1), (hub,)])
+        self.assertEqual(view._scripts, ['Hub.ack(1)'])
+
+        # Unacknowledged messages are re-sent, only new ones get emitted:
+        view._title = json.dumps({'session': 'A', 'flush': 2, 'batch': [
+            {'i': 1, 'signal': 'foo', 'args': []},
+            {'i': 2, 'signal': 'bar', 'args': [2]},
+        ]})
+        self.assertIsNone(hub._on_notify_title(view, None))
+        self.assertEqual(cb._calls, [(hub, 1), (hub,), (hub, 2)])
+        self.assertEqual(view._scripts, ['Hub.ack(1)', 'Hub.ack(2)'])
+
+        # A batch with nothing new isn't acknowledged again:
+        self.assertIsNone(hub._recv_batch('A', []))
+        self.assertEqual(len(view._scripts), 2)
+
+        # Gaps in the sequence are detected:
+        self.assertEqual(hub.gaps, 0)
+        hub._recv_batch('A', [{'i': 5, 'signal': 'foo', 'args': []}])
+        self.assertEqual(hub.gaps, 1)
+        self.assertEqual(view._scripts[-1], 'Hub.ack(5)')
+
+        # New session (page reload) starts the sequence over:
+        cb._calls = []
+        hub._recv_batch('B', [{'i': 0, 'signal': 'bar', 'args': [3]}])
+        self.assertEqual(cb._calls, [(hub, 3)])
+        self.assertEqual(hub.gaps, 1)
+        self.assertEqual(view._scripts[-1], 'Hub.ack(0)')
+
+        # Chunked messages are reassembled before the signal is emitted:
+        cb._calls = []
+        data = json.dumps({'signal': 'bar', 'args': ['x' * 10]})
+        chunks = list(userwebkit.iter_chunks(data, 8))
+        batch = [
+            {'i': i + 1, 'chunk': chunk, 'more': more}
+            for (i, (chunk, more)) in enumerate(chunks)
+        ]
+        hub._recv_batch('B', batch[:2])
+        self.assertEqual(cb._calls, [])
+        self.assertEqual(view._scripts[-1], 'Hub.ack(2)')
+        hub._recv_batch('B', batch[1:])
+        self.assertEqual(cb._calls, [(hub, 'x' * 10)])
+        self.assertEqual(hub._chunks, [])
+        self.assertEqual(view._scripts[-1], 'Hub.ack({})'.format(len(batch)))
+
+        # A gap in the middle of a transfer discards the partial message:
+        hub._recv_batch('C', [dict(batch[0], i=0)])
+        self.assertEqual(hub._chunks, [chunks[0][0]])
+        hub._recv_batch('C', [{'i': 5, 'signal': 'foo', 'args': []}])
+        self.assertEqual(hub._chunks, [])
+        self.assertEqual(hub.gaps, 2)
+
+
+class TestHubBus(TestCase):
+    def test_init(self):
+        bus = userwebkit.HubBus()
+        self.assertIs(bus._hub_class, userwebkit.Hub)
+        self.assertIs(bus._batch, False)
+        self.assertEqual(bus._chunk_size, userwebkit.CHUNK_SIZE)
+        self.assertEqual(bus.hubs, [])
+
+    def test_add(self):
+        signals = {'foo': ['one']}
+        bus = userwebkit.hub_factory(signals, userwebkit.HubBus)(
+            userwebkit.hub_factory(signals), True, 1024
+        )
+        self.assertIsInstance(bus, userwebkit.HubBus)
+        view = DummyCouchView()
+        hub = bus.add(view)
+        self.assertIsInstance(hub, userwebkit.Hub)
+        self.assertIs(hub._view, view)
+        self.assertIs(hub._batch, True)
+        self.assertEqual(hub._chunk_size, 1024)
+        self.assertIs(hub.bus, bus)
+        self.assertEqual(bus.hubs, [hub])
+        hub.send('foo', 'bar')
+        self.assertIsNotNone(hub._flush_id)
+        self.assertIsNone(bus.remove(hub))
+        self.assertIsNone(hub.bus)
+        self.assertEqual(bus.hubs, [])
+
+        # The removed hub stops listening and drops undelivered messages:
+        self.assertEqual(view._disconnect, 17)
+        self.assertIsNone(hub._flush_id)
+        self.assertEqual(hub._queue, [])
+        self.assertEqual(view._scripts, [])
+
+    def test_send(self):
+        signals = {'foo': ['one']}
+        bus = userwebkit.hub_factory(signals, userwebkit.HubBus)(
+            userwebkit.hub_factory(signals)
+        )
+        cb = DummyCallback()
+        bus.connect('foo', cb)
+        view1 = DummyCouchView()
+        view2 = DummyCouchView()
+        hub1 = bus.add(view1)
+        hub2 = bus.add(view2)
+        hub_cb = DummyCallback()
+        hub1.connect('foo', hub_cb)
+
+        # Sent to all pages, emitted once on the bus:
+        bus.send('foo', 17)
+        script = 'Hub.recv(\'{"args": [17], "signal": "foo"}\')'
+        self.assertEqual(view1._scripts, [script])
+        self.assertEqual(view2._scripts, [script])
+        self.assertEqual(cb._calls, [(bus, 17)])
+        self.assertEqual(hub_cb._calls, [])
+
+        # Sent from a page, relayed to the other pages:
+        view1._title = json.dumps({'signal': 'foo', 'args': ['bar']})
+        hub1._on_notify_title(view1, None)
+        self.assertEqual(view1._scripts, [script])
+        self.assertEqual(view2._scripts,
+            [script, 'Hub.recv(\'{"args": ["bar"], "signal": "foo"}\')']
+        )
+        self.assertEqual(cb._calls, [(bus, 17), (bus, 'bar')])
+        self.assertEqual(hub_cb._calls, [(hub1, 'bar')])
+
+        # Only the hub whose page sent the signal emits it:
+        hub2_cb = DummyCallback()
+        hub2.connect('foo', hub2_cb)
+        hub1._on_notify_title(view1, None)
+        self.assertEqual(hub_cb._calls, [(hub1, 'bar'), (hub1, 'bar')])
+        self.assertEqual(hub2_cb._calls, [])
+
+
+class TestChangesFeed(TestCase):
+    def test_init(self):
+        db = DummyChangesDatabase()
+        cb = DummyCallback()
+        feed = userwebkit.ChangesFeed(db, cb)
+        self.assertIs(feed.db, db)
+        self.assertIs(feed.callback, cb)
+        self.assertEqual(feed.since, 'now')
+        self.assertIs(feed.relevant, userwebkit.is_relevant)
+        self.assertIs(feed.stopped, False)
+        self.assertEqual(feed.batches, 0)
+        self.assertIsNone(feed._idle_id)
+
+    def test_follow(self):
+        cb = DummyCallback()
+        feed = userwebkit.ChangesFeed(DummyChangesDatabase(), cb, 3)
+        rows = [
+            {'seq': 4, 'id': 'foo', 'doc': {'_id': 'foo', 'n': 1}},
+            {'seq': 5, 'id': '_design/bar'},
+            {'seq': 6, 'id': 'baz', 'doc': {'_id': 'baz'}},
+            {'seq': 7, 'id': 'foo', 'doc': {'_id': 'foo', 'n': 2}},
+        ]
+        feed.follow(changes_response(rows + [{'last_seq': 8}]))
+        self.assertEqual(feed.since, 8)
+        self.assertIsNotNone(feed._idle_id)
+
+        # Only relevant docs, only the latest change to each, one batch:
+        self.assertIs(feed._on_idle(), False)
+        self.assertIsNone(feed._idle_id)
+        self.assertEqual(cb._calls,
+            [({'last_seq': 7, 'results': [rows[2], rows[3]]},)]
+        )
+        self.assertEqual(feed.batches, 1)
+        self.assertIs(feed._on_idle(), False)
+        self.assertEqual(len(cb._calls), 1)
+
+        # Nothing is delivered once stopped:
+        feed.follow(changes_response(rows[:1]))
+        self.assertEqual(feed.since, 4)
+        feed.stop()
+        self.assertIs(feed._on_idle(), False)
+        self.assertEqual(len(cb._calls), 1)
+
+    def test_run(self):
+        cb = DummyCallback()
+        db = DummyChangesDatabase()
+        feed = userwebkit.ChangesFeed(db, cb, 3)
+        db._feed = feed
+        feed.retry = 0
+        feed.start()
+        feed._thread.join(5)
+        self.assertIs(feed._thread.is_alive(), False)
+        self.assertEqual(db._calls,
+            [
+                ('GET', ('_changes',), {
+                    'feed': 'continuous',
+                    'heartbeat': 10000,
+                    'include_docs': True,
+                    'since': 3,
+                }),
+                ('GET', ('_changes',), {
+                    'feed': 'continuous',
+                    'heartbeat': 10000,
+                    'include_docs': True,
+                    'since': 3,
+                }),
+                ('GET', ('_changes',), {
+                    'feed': 'continuous',
+                    'heartbeat': 10000,
+                    'include_docs': True,
+                    'since': 4,
+                }),
+            ]
+        )
+        self.assertEqual(db.ctx._released, [True, True, True])
+        self.assertEqual(feed.batches, 0)
+        self.assertEqual(feed.since, 4)
+        self.assertEqual(db.ctx._conn.sock._timeout, 30)
+        self.assertIsNone(feed._sock)
+
+    def test_timeout(self):
+        class TimeoutResponse:
+            def readline(self):
+                raise socket.timeout('timed out')
+
+        class TimeoutDatabase(DummyChangesDatabase):
+            def _request(self, method, parts, options):
+                self._calls.append(options['since'])
+                if len(self._calls) == 2:
+                    self._feed.stop()
+                return TimeoutResponse()
+
+        db = TimeoutDatabase()
+        feed = userwebkit.ChangesFeed(db, DummyCallback(), 3)
+        db._feed = feed
+        feed.retry = 0
+        feed.start()
+        feed._thread.join(5)
+        self.assertIs(feed._thread.is_alive(), False)
+
+        # A read timeout is treated as a dead connection and reconnected:
+        self.assertEqual(db._calls, [3, 3])
+        self.assertEqual(db.ctx._released, [True, True])
+
+        # stop() interrupts a worker blocked on the socket:
+        sock = DummySocket()
+        feed._sock = sock
+        feed.stop()
+        self.assertEqual(sock._shutdown, socket.SHUT_RDWR)
+
+
+class TestBackgroundTask(TestCase):
+    def test_init(self):
+        cb = DummyCallback()
+        task = userwebkit.BackgroundTask(sum, ([1, 2],), cb)
+        self.assertIs(task.func, sum)
+        self.assertEqual(task.args, ([1, 2],))
+        self.assertIs(task.callback, cb)
+        self.assertIsNone(task.error_callback)
+        self.assertIs(task.cancelled, False)
+        self.assertIsNone(task.future)
+        self.assertIs(task.wait(0), False)
+
+    def test_run(self):
+        task = userwebkit.BackgroundTask(sum, ([1, 2],))
+        self.assertIsNone(task.run())
+        self.assertIs(task.wait(0), True)
+
+        # Exceptions are caught in the worker thread:
+        task = userwebkit.BackgroundTask(int, ('nope',))
+        self.assertIsNone(task.run())
+        self.assertIs(task.wait(0), True)
+
+        # Cancelled tasks aren't run:
+        cb = DummyCallback()
+        task = userwebkit.BackgroundTask(cb, ('foo',))
+        task.cancel()
+        self.assertIsNone(task.run())
+        self.assertIs(task.wait(0), True)
+        self.assertEqual(cb._calls, [])
+
+    def test_deliver(self):
+        cb = DummyCallback()
+        error_cb = DummyCallback()
+        task = userwebkit.BackgroundTask(sum, ([1, 2],), cb, error_cb)
+        self.assertIs(task.deliver(3, None), False)
+        self.assertEqual(cb._calls, [(3,)])
+        error = ValueError('nope')
+        self.assertIs(task.deliver(None, error), False)
+        self.assertEqual(error_cb._calls, [(error,)])
+
+        # Nothing is delivered once cancelled:
+        task.cancel()
+        self.assertIs(task.cancelled, True)
+        self.assertIs(task.deliver(3, None), False)
+        self.assertIs(task.deliver(None, error), False)
+        self.assertEqual(cb._calls, [(3,)])
+        self.assertEqual(error_cb._calls, [(error,)])
+
+        # Without callbacks, errors are logged:
+        task = userwebkit.BackgroundTask(sum, ([1, 2],))
+        self.assertIs(task.deliver(3, None), False)
+        self.assertIs(task.deliver(None, error), False)
+
+    def test_run_in_thread(self):
+        cb = DummyCallback()
+        task = userwebkit.run_in_thread(cb, 'foo', 'bar')
+        self.assertIsInstance(task, userwebkit.BackgroundTask)
+        self.assertIs(task.wait(5), True)
+        self.assertEqual(cb._calls, [('foo', 'bar')])
+
+
+class TestConnectionPool(TestCase):
+    def test_init(self):
+        connect = DummyConnect()
+        pool = ConnectionPool(connect)
+        self.assertIs(pool.connect, connect)
+        self.assertEqual(pool.size, 5)
+        self.assertEqual(pool.idle_timeout, 30)
+        self.assertEqual(pool.stats(),
+            {'created': 0, 'reused': 0, 'evicted': 0, 'idle': 0}
+        )
+
+    def test_checkout(self):
+        connect = DummyConnect()
+        pool = ConnectionPool(connect, size=2)
+        conn1 = pool.checkout()
+        conn2 = pool.checkout()
+        self.assertIsNot(conn1, conn2)
+        self.assertEqual(connect._conns, [conn1, conn2])
+
+        # Can't check out more than size connections at once:
+        with self.assertRaises(TimeoutError) as cm:
+            pool.checkout(timeout=0.01)
+        self.assertEqual(str(cm.exception),
+            'no connection available after 0.01s'
+        )
+
+        # Checked in connections are reused:
+        self.assertIsNone(pool.checkin(conn2))
+        self.assertIs(pool.checkout(), conn2)
+        self.assertEqual(pool.stats(),
+            {'created': 2, 'reused': 1, 'evicted': 0, 'idle': 0}
+        )
+
+        # Discarded connections are closed and not reused:
+        self.assertIsNone(pool.checkin(conn1, discard=True))
+        self.assertIs(conn1._closed, True)
+        conn3 = pool.checkout()
+        self.assertEqual(connect._conns, [conn1, conn2, conn3])
+
+        # Idle connections are evicted after idle_timeout:
+        pool.checkin(conn2)
+        pool.checkin(conn3)
+        self.assertEqual(pool.stats()['idle'], 2)
+        pool.idle_timeout = -1
+        conn4 = pool.checkout()
+        self.assertIs(conn2._closed, True)
+        self.assertIs(conn3._closed, True)
+        self.assertEqual(connect._conns, [conn1, conn2, conn3, conn4])
+        self.assertEqual(pool.stats(),
+            {'created': 4, 'reused': 1, 'evicted': 2, 'idle': 0}
+        )
+
+    def test_close(self):
+        pool = ConnectionPool(DummyConnect())
+        conn = pool.checkout()
+        pool.checkin(conn)
+        self.assertIsNone(pool.close())
+        self.assertIs(conn._closed, True)
+        self.assertEqual(pool.stats()['idle'], 0)
+
+        # Connections checked in after close() are closed too:
+        conn = pool.checkout()
+        pool.checkin(conn)
+        self.assertIs(conn._closed, True)
+        self.assertEqual(pool.stats()['idle'], 0)
+
+
+class TestPooledContext(TestCase):
+    def test_get_connection(self):
+        ctx = PooledContext(random_env(), size=2)
+        self.assertIsInstance(ctx, microfiber.Context)
+        self.assertIsInstance(ctx.pool, ConnectionPool)
+        self.assertEqual(ctx.pool.size, 2)
+
+        def in_thread(func):
+            result = []
+            thread = threading.Thread(target=lambda: result.append(func()))
+            thread.start()
+            thread.join()
+            return result[0]
+
+        # Same thread keeps the same connection until release():
+        def reuse():
+            conn = ctx.get_connection()
+            self.assertIs(ctx.get_connection(), conn)
+            ctx.release()
+            ctx.release()
+            return conn
+        conn = in_thread(reuse)
+        self.assertIs(in_thread(reuse), conn)
+        self.assertEqual(ctx.pool.stats()['reused'], 1)
+
+        # Discarded connections aren't reused:
+        def discard():
+            conn = ctx.get_connection()
+            ctx.release(discard=True)
+            return conn
+        self.assertIs(in_thread(discard), conn)
+        conn2 = in_thread(reuse)
+        self.assertIsNot(conn2, conn)
+        self.assertEqual(ctx.pool.stats()['created'], 2)
+
+        # The owner thread never uses the pool, even when it's exhausted:
+        held = [ctx.pool.checkout(), ctx.pool.checkout()]
+        owner = ctx.get_connection()
+        self.assertNotIn(owner, held + [conn, conn2])
+        self.assertIs(ctx.get_connection(), owner)
+        self.assertIsNone(ctx.release())
+        self.assertIs(ctx.get_connection(), owner)
+        self.assertIsNone(ctx.release(discard=True))
+        self.assertIsNot(ctx.get_connection(), owner)
+        for c in held:
+            ctx.pool.checkin(c)
+
+        # close() closes the owner's connection and the idle ones:
+        owner = ctx.get_connection()
+        self.assertIsNone(ctx.close())
+        self.assertIs(ctx.pool.closed, True)
+        self.assertEqual(ctx.pool.stats()['idle'], 0)
+
+    def test_release_all(self):
+        ctx1 = PooledContext(random_env(), size=1)
+        ctx2 = PooledContext(random_env(), size=1)
+
+        def work():
+            ctx1.get_connection()
+            ctx2.get_connection()
+            release_all()
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        self.assertEqual(ctx1.pool.stats()['idle'], 1)
+        self.assertEqual(ctx2.pool.stats()['idle'], 1)
+
+
+class TestResourceTimings(TestCase):
+    def test_init(self):
+        timings = userwebkit.ResourceTimings()
+        self.assertEqual(timings.size, 500)
+        self.assertEqual(timings.records.maxlen, 500)
+        self.assertEqual(timings.export(),
+            {
+                'resources': [],
+                'pending': 0,
+                'dropped': 0,
+                'by_scheme': {},
+                'by_host': {},
+                'handler': 0.0,
+            }
+        )
+
+    def test_start(self):
+        timings = userwebkit.ResourceTimings(2)
+        url = 'http://localhost:5984/foo'
+        timings.start('a', url, url, 0.5)
+        timings.start('b', 'dmedia:FOO', 'file:///tmp/foo', 0.25)
+        timings.finish('a')
+        timings.finish('b', 'failed')
+        timings.finish('nope')
+        data = 'data:image/png;base64,AAAA'
+        timings.start('c', data, data, 0.0)
+        timings.finish('c')
+        data = timings.export()
+        self.assertEqual([r['uri'] for r in data['resources']],
+            ['dmedia:FOO', 'data:image/png;base64,AAAA']
+        )
+        self.assertEqual(data['resources'][0]['final_uri'], 'file:///tmp/foo')
+        self.assertEqual(data['resources'][0]['status'], 'failed')
+        self.assertEqual(data['resources'][0]['handler'], 0.25)
+        self.assertGreaterEqual(data['resources'][0]['duration'], 0)
+        self.assertEqual(data['by_scheme'],
+            {'http': 1, 'dmedia': 1, 'data': 1}
+        )
+        self.assertEqual(data['by_host'], {'localhost:5984': 1})
+        self.assertEqual(data['handler'], 0.75)
+        self.assertEqual(json.loads(timings.to_json()), data)
+
+        # Resources that never finish don't pile up:
+        for i in range(3):
+            timings.start(i, 'http://example.com/', 'http://example.com/', 0)
+        self.assertEqual(list(timings.pending), [1, 2])
+        self.assertEqual(timings.dropped, 1)
+
+
+class TestDmediaCache(TestCase):
+    def test_init(self):
+        resolver = DummyResolver()
+        cache = userwebkit.DmediaCache(resolver)
+        self.assertIs(cache.resolver, resolver)
+        self.assertIsNone(cache.resolve_many)
+        self.assertEqual(cache.size, 2048)
+        self.assertEqual(cache.ttl, 300)
+        self.assertEqual(cache.negative_ttl, 10)
+        self.assertEqual(len(cache), 0)
+
+    def test_resolve(self):
+        resolver = DummyResolver()
+        cache = userwebkit.DmediaCache(resolver, size=2)
+        id1 = random_id(30)
+        id2 = random_id(30)
+        id3 = random_id(30)
+        r1 = cache.resolve(id1)
+        self.assertEqual(r1,
+            (id1, 0, path.join('/home/.dmedia/files', id1[:2], id1[2:]))
+        )
+        self.assertIs(cache.resolve(id1), r1)
+        self.assertEqual(resolver._calls, [id1])
+
+        # Least recently used entry should be evicted:
+        cache.resolve(id2)
+        cache.resolve(id1)
+        cache.resolve(id3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(id2))
+        self.assertIs(cache.get(id1), r1)
+        self.assertEqual(resolver._calls, [id1, id2, id3])
+
+        # Expired entries should be resolved again:
+        cache.ttl = -1
+        cache.clear()
+        cache.resolve(id1)
+        cache.resolve(id1)
+        self.assertEqual(resolver._calls, [id1, id2, id3, id1, id1])
+
+    def test_negative(self):
+        resolver = DummyCallback()
+        cache = userwebkit.DmediaCache(resolver)
+        _id = random_id(30)
+        cache.store((_id, 3, ''))
+        self.assertEqual(cache.resolve(_id), (_id, 3, ''))
+        self.assertEqual(resolver._calls, [])
+        cache.negative_ttl = -1
+        cache.store((_id, 3, ''))
+        self.assertIsNone(cache.get(_id))
+
+    def test_prefetch(self):
+        resolver = DummyResolver()
+        many = DummyResolveMany()
+        cache = userwebkit.DmediaCache(resolver, many)
+        ids = [random_id(30) for i in range(5)]
+        cache.store((ids[0], 0, '/foo'))
+        task = cache.prefetch(ids + ids[1:2])
+        self.assertIsInstance(task, userwebkit.BackgroundTask)
+        self.assertIs(task.wait(5), True)
+        self.assertEqual(many._calls, [ids[1:]])
+        self.assertEqual(resolver._calls, [])
+        for _id in ids[1:]:
+            self.assertEqual(cache.resolve(_id), (_id, 3, ''))
+        self.assertEqual(resolver._calls, [])
+        self.assertIsNone(cache.prefetch(ids))
+
+        # Without resolve_many, falls back to calling resolver in the thread:
+        cache = userwebkit.DmediaCache(resolver)
+        self.assertIs(cache.prefetch(ids[:2]).wait(5), True)
+        self.assertEqual(resolver._calls, ids[:2])
+
+        # A custom background runner can be provided:
+        background = DummyBackground()
+        cache = userwebkit.DmediaCache(resolver, many, background=background)
+        self.assertIs(cache.background, background)
+        cache.prefetch(ids[3:])
+        self.assertEqual(background._calls,
+            [(cache._resolve_many, (ids[3:],), None, None)]
+        )
+
+
 class TestCouchView(TestCase):
     def tearDown(self):
-        userwebkit.log = orig_log
+        userwebkit_view.log = orig_log
 
     def test_init(self):
-        view = userwebkit.CouchView()
+        view = userwebkit_view.CouchView()
         self.assertIsNone(view._env)
         self.assertIsNone(view._u)
+        self.assertIsNone(view._base)
+        self.assertIsNone(view._prefix)
         self.assertIsNone(view._oauth)
         self.assertIsNone(view._authorization)
 
-        view = userwebkit.CouchView(None)
+        view = userwebkit_view.CouchView(None)
         self.assertIsNone(view._env)
         self.assertIsNone(view._u)
         self.assertIsNone(view._oauth)
         self.assertIsNone(view._authorization)
 
         env = random_env()
-        view = userwebkit.CouchView(env)
+        view = userwebkit_view.CouchView(env)
         self.assertIs(view._env, env)
         self.assertEqual(view._u, urlparse(env['url']))
         self.assertEqual(view._oauth, env['oauth'])
@@ -250,19 +1180,21 @@ class TestCouchView(TestCase):
 
         auth = random_id()
         env['authorization'] = auth
-        view = userwebkit.CouchView(env)
+        view = userwebkit_view.CouchView(env)
         self.assertIs(view._env, env)
         self.assertEqual(view._u, urlparse(env['url']))
         self.assertEqual(view._oauth, env['oauth'])
         self.assertIs(view._authorization, auth)
 
     def test_set_env(self):
-        view = userwebkit.CouchView()
+        view = userwebkit_view.CouchView()
 
         env = random_env()
         self.assertIsNone(view.set_env(env))
         self.assertIs(view._env, env)
         self.assertEqual(view._u, urlparse(env['url']))
+        self.assertEqual(view._base, env['url'][:-1])
+        self.assertEqual(view._prefix, env['url'])
         self.assertEqual(view._oauth, env['oauth'])
         self.assertEqual(view._authorization,
             basic_auth_header(env['basic'])
@@ -270,7 +1202,7 @@ class TestCouchView(TestCase):
 
         auth = random_id()
         env['authorization'] = auth
-        view = userwebkit.CouchView(env)
+        view = userwebkit_view.CouchView(env)
         self.assertIs(view._env, env)
         self.assertEqual(view._u, urlparse(env['url']))
         self.assertEqual(view._oauth, env['oauth'])
@@ -295,20 +1227,109 @@ class TestCouchView(TestCase):
         self.assertIsNone(view.set_env(None))
         self.assertIsNone(view._env)
         self.assertIsNone(view._u)
+        self.assertIsNone(view._base)
+        self.assertIsNone(view._prefix)
         self.assertIsNone(view._oauth)
         self.assertIsNone(view._authorization)
 
+    def test_set_assets(self):
+        view = userwebkit_view.CouchView()
+        self.assertIsNone(view._assets_path)
+        self.assertIsNone(view._assets_dir)
+        self.assertIsNone(view.set_assets('/_apps/foo/', '/tmp/foo'))
+        self.assertEqual(view._assets_path, '/_apps/foo/')
+        self.assertEqual(view._assets_dir, '/tmp/foo')
+        self.assertIsNone(view.set_assets(None, None))
+        self.assertIsNone(view._assets_path)
+        self.assertIsNone(view._assets_dir)
+
+    def test_on_request_assets(self):
+        with TemporaryDirectory() as tmp:
+            open(path.join(tmp, 'base.js'), 'w').write('"use strict";')
+            open(path.join(tmp, 'index.html'), 'w').write('<html></html>')
+            env = random_env()
+            del env['oauth']
+            view = userwebkit_view.CouchView(env)
+            view.set_assets('/_apps/foo/', tmp)
+
+            # Existing assets are loaded from disk, without authorization:
+            message = DummyMessage()
+            request = DummyRequest(env['url'] + '_apps/foo/base.js', message)
+            self.assertIsNone(
+                view._on_request(None, None, None, request, None)
+            )
+            self.assertEqual(request._set_uri,
+                'file://' + path.join(tmp, 'base.js')
+            )
+            self.assertEqual(message.request_headers._headers, [])
+
+            # Pages, missing files and other paths still go to CouchDB:
+            for relpath in ('_apps/foo/index.html', '_apps/foo/nope.js',
+                    '_apps/bar/base.js', 'foo/_design/bar/base.js'):
+                message = DummyMessage()
+                request = DummyRequest(env['url'] + relpath, message)
+                self.assertIsNone(
+                    view._on_request(None, None, None, request, None)
+                )
+                self.assertIsNone(request._set_uri)
+                self.assertEqual(message.request_headers._headers,
+                    [('authorization', basic_auth_header(env['basic']))]
+                )
+
     def test_enable_logging(self):
-        view = userwebkit.CouchView()
+        view = userwebkit_view.CouchView()
         self.assertFalse(view._logging_enabled)
         self.assertIsNone(view.enable_logging())
         self.assertTrue(view._logging_enabled)
         self.assertIsNone(view.enable_logging())
 
+    def test_prefetch_dmedia(self):
+        view = userwebkit_view.CouchView()
+        self.assertIsNone(view._dmedia_cache)
+        self.assertIsNone(view.prefetch_dmedia([random_id(30)]))
+
+        resolver = DummyResolver()
+        many = DummyResolveMany()
+        view = userwebkit_view.CouchView(None, resolver, many)
+        self.assertIsInstance(view._dmedia_cache, userwebkit.DmediaCache)
+        ids = [random_id(30), random_id(30)]
+        self.assertIs(view.prefetch_dmedia(ids).wait(5), True)
+        self.assertEqual(many._calls, [ids])
+        self.assertEqual(view._dmedia_cache.get(ids[0]), (ids[0], 3, ''))
+
+    def test_enable_timings(self):
+        env = random_env()
+        view = userwebkit_view.CouchView(env)
+        self.assertIsNone(view.timings)
+        view.enable_timings(10)
+        timings = view.timings
+        self.assertIsInstance(timings, userwebkit.ResourceTimings)
+        self.assertEqual(timings.size, 10)
+        view.enable_timings()
+        self.assertIs(view.timings, timings)
+
+        message = DummyMessage()
+        request = DummyRequest(env['url'] + 'foo/bar', message)
+        resource = object()
+        self.assertIsNone(
+            view._on_request_timed(None, None, resource, request, None)
+        )
+        self.assertEqual(len(message.request_headers._headers), 1)
+        self.assertEqual(list(timings.pending), [resource])
+        view._on_load_finished(view, None, resource)
+        self.assertEqual(timings.records[0]['status'], 'finished')
+        resource = object()
+        view._on_request_timed(None, None, resource,
+            DummyRequest('http://www.ubuntu.com/'), None
+        )
+        view._on_load_failed(view, None, resource, None)
+        self.assertEqual(timings.records[1]['status'], 'failed')
+        self.assertEqual(timings.export()['by_scheme'], {'http': 2})
+
     def test_on_console_message(self):
-        view = userwebkit.CouchView()
+        view = userwebkit_view.CouchView()
         log = DummyLogger()
-        userwebkit.log = log
+        userwebkit_view.log = log
         message = 'hello ' + random_id()
         line = 25
         source_id = 'http://localhost:36163/_intree/index.html'
@@ -319,7 +1340,7 @@ class TestCouchView(TestCase):
         )
 
     def test_on_request(self):
-        view = userwebkit.CouchView()
+        view = userwebkit_view.CouchView()
         self.assertIsNone(view._env)
 
         # Make sure on_request() immediately returns when env is None:
@@ -337,7 +1358,7 @@ class TestCouchView(TestCase):
         # Test with dmedia: URI when dmedia_resolver is callable:
         env = random_env()
         resolver = DummyResolver()
-        view = userwebkit.CouchView(env, resolver)
+        view = userwebkit_view.CouchView(env, resolver)
         self.assertIs(view._dmedia_resolver, resolver)
         id1 = random_id(30)
         uri1 = 'dmedia:' + id1
@@ -360,9 +1381,49 @@ class TestCouchView(TestCase):
         )
         self.assertEqual(resolver._calls, [id1, id2])
 
+        # Repeated loads should be served from the cache:
+        request = DummyRequest(uri1)
+        self.assertIsNone(view._on_request(None, None, None, request, None))
+        self.assertEqual(
+            request._set_uri,
+            '/'.join(['file:///home/.dmedia/files', id1[:2], id1[2:]])
+        )
+        self.assertEqual(resolver._calls, [id1, id2])
+
+        # Other URIs should be ignored without ever looking at the message:
+        for uri in ('file:///usr/share/foo.html', 'data:image/png;base64,AA',
+                'http://www.ubuntu.com/', env['url'][:-1] + '0/foo'):
+            request = DummyRequest(uri)
+            self.assertIsNone(
+                view._on_request(None, None, None, request, None)
+            )
+            self.assertIsNone(request._set_uri)
+
+        # Requests to CouchDB with basic auth get the precomputed header:
+        env = random_env()
+        del env['oauth']
+        view = userwebkit_view.CouchView(env)
+        message = DummyMessage()
+        request = DummyRequest(env['url'] + 'foo/bar', message)
+        self.assertIsNone(view._on_request(None, None, None, request, None))
+        self.assertEqual(message.request_headers._headers,
+            [('authorization', basic_auth_header(env['basic']))]
+        )
+
+        # Requests to CouchDB with OAuth get a freshly signed header:
+        env = random_env()
+        view = userwebkit_view.CouchView(env)
+        message = DummyMessage('POST')
+        request = DummyRequest(env['url'] + 'foo/_bulk_docs?bar', message)
+        self.assertIsNone(view._on_request(None, None, None, request, None))
+        headers = message.request_headers._headers
+        self.assertEqual(len(headers), 1)
+        self.assertEqual(headers[0][0], 'authorization')
+        self.assertTrue(headers[0][1].startswith('OAuth '))
+
     def test_on_nav_policy_decision(self):
         callback = DummyCallback()
-        view = userwebkit.CouchView()
+        view = userwebkit_view.CouchView()
         view.connect('open', callback)
 
         # Make sure on_request() immediately returns when env is None:
@@ -435,12 +1496,124 @@ class TestCouchView(TestCase):
                 (view, 'https://launchpad.net/novacut'),  
             ]
         )
-        
-        
+
+
+
+class TestViewPool(TestCase):
+    def test_init(self):
+        pool = userwebkit_view.ViewPool()
+        self.assertEqual(pool.size, 1)
+        self.assertIsNone(pool.setup)
+        self.assertEqual(len(pool), 0)
+        self.assertIsNone(pool._idle_id)
+
+    def test_get(self):
+        setup = DummyCallback()
+        pool = userwebkit_view.ViewPool(2, setup)
+        env = random_env()
+        pool.set_env(env)
+
+        # Empty pool builds a view right away, then schedules a refill:
+        view = pool.get()
+        self.assertIsInstance(view, userwebkit_view.CouchView)
+        self.assertEqual(view._env, env)
+        self.assertEqual(setup._calls, [(view,)])
+        self.assertIsNotNone(pool._idle_id)
+        self.assertEqual(len(pool), 0)
+
+        # Refill builds one view per idle callback until *size* are ready:
+        self.assertIs(pool._on_idle(), True)
+        self.assertIs(pool._on_idle(), False)
+        self.assertIsNone(pool._idle_id)
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(len(setup._calls), 3)
+        ready = list(pool._views)
+
+        # set_env() and set_assets() update the pre-built views:
+        env2 = random_env()
+        pool.set_env(env2)
+        pool.set_assets('file:///tmp/ui', '/tmp/ui')
+        for v in ready:
+            self.assertEqual(v._env, env2)
+            self.assertEqual(v._assets_path, 'file:///tmp/ui')
+            self.assertEqual(v._assets_dir, '/tmp/ui')
+
+        # get() now hands out a pre-built view:
+        self.assertIs(pool.get(), ready[0])
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(len(setup._calls), 3)
+
+    def test_release(self):
+        calls = []
+        def instrument(view):
+            view.stop_loading = lambda: calls.append((view, 'stop'))
+            view.load_uri = lambda uri: calls.append((view, uri))
+            view.destroy = lambda: calls.append((view, 'destroy'))
+
+        pool = userwebkit_view.ViewPool(1, instrument)
+        env = random_env()
+        pool.set_env(env)
+        view1 = pool.get()
+        view2 = pool.get()
+        view1.set_env(None)
+
+        # Under size, view is reset and kept:
+        pool.release(view1)
+        self.assertEqual(calls, [(view1, 'stop'), (view1, 'about:blank')])
+        self.assertEqual(pool._views, [view1])
+        self.assertEqual(view1._env, env)
+
+        # Full, view is destroyed:
+        pool.release(view2)
+        self.assertEqual(calls[2:],
+            [(view2, 'stop'), (view2, 'about:blank'), (view2, 'destroy')]
+        )
+        self.assertEqual(pool._views, [view1])
+
+        # A pool that builds nothing ahead of time still reuses a view:
+        pool = userwebkit_view.ViewPool(0, instrument)
+        view3 = pool.get()
+        self.assertIsNone(pool._idle_id)
+        pool.release(view3)
+        self.assertEqual(pool._views, [view3])
+        self.assertIs(pool.get(), view3)
+
+
 class DummyOptions:
-    def __init__(self, benchmark=False, page=None):
+    def __init__(self, benchmark=False, page=None, benchmark_runs=1,
+            benchmark_report=None):
         self.benchmark = benchmark
         self.page = page
+        self.benchmark_runs = benchmark_runs
+        self.benchmark_report = benchmark_report
+
+
+class DummyDatabase:
+    def __init__(self, stale=False, docs=None):
+        self._stale = stale
+        self._docs = (docs or {})
+        self._calls = []
+
+    def ensure(self):
+        self._calls.append('ensure')
+        if self._stale:
+            raise ConnectionRefusedError()
+        return True
+
+    def post(self, obj, *parts, **options):
+        assert parts == ('_all_docs',)
+        assert options == {'include_docs': True}
+        self._calls.append(('_all_docs', obj['keys']))
+        rows = []
+        for _id in obj['keys']:
+            if _id in self._docs:
+                rows.append({'id': _id, 'doc': self._docs[_id]})
+            else:
+                rows.append({'key': _id, 'error': 'not_found'})
+        return {'rows': rows}
+
+    def save(self, doc):
+        self._calls.append(('save', doc['_id'], doc.get('_rev')))
 
 
 class DummyServer:
@@ -456,6 +1629,8 @@ class DummyServer:
 class TestBaseApp(TestCase):
     def test_init(self):
         app = userwebkit.BaseApp()
+        self.assertIsInstance(app.start, float)
+        self.assertEqual(app.timings, [])
         self.assertIsNone(app.inspector)
         self.assertIsNone(app.env)
         self.assertIsInstance(app.intree, bool)
@@ -464,6 +1639,7 @@ class TestBaseApp(TestCase):
         # Test all the default class attribute values:
         self.assertEqual(app.name, 'userwebkit')
         self.assertEqual(app.dbname, 'userwebkit-0')
+        self.assertIsNone(app.databases)
         self.assertIsNone(app.version)
         self.assertEqual(app.title, 'App Window Title')
         self.assertEqual(app.page, 'index.html')
@@ -471,14 +1647,245 @@ class TestBaseApp(TestCase):
         self.assertIs(app.enable_inspector, True)
 
         self.assertIsNone(app.dmedia_resolver)
+        self.assertIsNone(app.dmedia_resolve_many)
 
         self.assertEqual(app.proxy_bus, 'org.freedesktop.DC3')
         self.assertEqual(app.proxy_path, '/')
+        self.assertIs(app.cache_env, True)
+        self.assertIs(app.serve_assets, False)
+        self.assertEqual(app.background_workers, 4)
+        self.assertEqual(app.max_connections, 5)
+        self.assertEqual(app.prewarm_views, 0)
+        self.assertIsNone(app.ctx)
+        self.assertIsNone(app.loaded_page)
 
         self.assertEqual(app.width, 960)
         self.assertEqual(app.height, 540)
         self.assertIs(app.maximize, False)
 
+    def test_mark(self):
+        app = userwebkit.BaseApp()
+        self.assertIsNone(app.mark('parse'))
+        self.assertIsNone(app.mark('build_window'))
+        self.assertEqual([name for (name, t) in app.timings],
+            ['parse', 'build_window']
+        )
+        (t1, t2) = [t for (name, t) in app.timings]
+        self.assertTrue(0 <= t1 <= t2)
+
+    def test_write_report(self):
+        report = userwebkit.benchmark_report([[('parse', 0.5)]])
+        with TemporaryDirectory() as tmp:
+            filename = path.join(tmp, 'report.json')
+            app = userwebkit.BaseApp()
+            app.options = DummyOptions(True, benchmark_report=filename)
+            self.assertIsNone(app.write_report(report))
+            self.assertEqual(json.load(open(filename, 'r')), report)
+
+    def test_env_cache(self):
+        with TemporaryDirectory() as tmp:
+            filename = path.join(tmp, 'foo', 'env.json')
+
+            class App(userwebkit.BaseApp):
+                def get_env_cache_filename(self):
+                    return filename
+
+            app = App()
+            self.assertIsNone(app.load_env_cache())
+            env = random_env()
+            self.assertIsNone(app.save_env_cache(env))
+            self.assertEqual(os.stat(filename).st_mode & 0o777, 0o600)
+            self.assertEqual(app.load_env_cache(), env)
+
+            # Corrupt or unexpected cache content is ignored:
+            open(filename, 'w').write('{"url": ')
+            self.assertIsNone(app.load_env_cache())
+            open(filename, 'w').write('["http://localhost:5984/"]')
+            self.assertIsNone(app.load_env_cache())
+
+    def test_request_env(self):
+        env = random_env()
+
+        class App(userwebkit.BaseApp):
+            def get_env(self):
+                return env
+
+        # An overridden get_env() is called in the background:
+        app = App()
+        app.run_in_background = DummyBackground()
+        self.assertIsNone(app.request_env())
+        self.assertEqual(app.run_in_background._calls,
+            [(app.get_env, tuple(), app.on_env, app.on_env_error)]
+        )
+
+    def test_on_env(self):
+        class App(userwebkit.BaseApp):
+            cache_env = False
+
+            def __init__(self):
+                super().__init__()
+                self._calls = []
+
+            def run_in_background(self, func, *args, callback=None,
+                    error_callback=None):
+                try:
+                    result = func(*args)
+                except Exception as e:
+                    error_callback(e)
+                    return
+                callback(result)
+
+            def set_env(self, env):
+                self.env = env
+                self.db = DummyDatabase(env.get('stale'))
+                self.dbs = {self.dbname: self.db}
+                self._calls.append(('set_env', env))
+
+            def post_env_init(self):
+                self._calls.append(('post_env_init',))
+
+            def load_page(self, page):
+                self._calls.append(('load_page', page))
+
+            def post_page_init(self, page):
+                self._calls.append(('post_page_init', page))
+
+        # Stale cached env is ignored:
+        app = App()
+        app.options = DummyOptions()
+        stale = random_env()
+        stale['stale'] = True
+        self.assertIsNone(app.on_env(stale, cached=True))
+        self.assertIsNone(app.env)
+        self.assertEqual(app._calls, [('set_env', stale)])
+        app._calls = []
+
+        # Good cached env loads the page right away:
+        env1 = random_env()
+        self.assertIsNone(app.on_env(env1, cached=True))
+        self.assertIs(app.env, env1)
+        self.assertEqual(app.loaded_page, 'index.html')
+        self.assertEqual(app._calls, [
+            ('set_env', env1),
+            ('post_env_init',),
+            ('load_page', 'index.html'),
+            ('post_page_init', 'index.html'),
+        ])
+
+        # Same env from DBus, nothing to do but note it's confirmed:
+        self.assertIs(app.env_cached, True)
+        self.assertIsNone(app.on_env(dict(env1)))
+        self.assertEqual(len(app._calls), 4)
+        self.assertIs(app.env_cached, False)
+
+        # Different env from DBus, page is reloaded:
+        env2 = random_env()
+        self.assertIsNone(app.on_env(env2))
+        self.assertIs(app.env, env2)
+        self.assertEqual(app._calls[4:], [
+            ('set_env', env2),
+            ('load_page', 'index.html'),
+        ])
+
+    def test_on_env_failed(self):
+        app = userwebkit.BaseApp()
+        app.ensure_databases = DummyCallback()
+        env = random_env()
+
+        # Cached env not yet confirmed by DBus is dropped as stale:
+        app.env = env
+        app.env_cached = True
+        pending = set(['userwebkit-0', 'foo-0'])
+        self.assertIsNone(app.on_env_failed(env, True, pending, 'oops'))
+        self.assertIsNone(app.env)
+        self.assertIs(app.env_cached, False)
+        self.assertEqual(app.ensure_databases._calls, [])
+
+        # Cached env that DBus confirmed meanwhile is ensured again, once:
+        app.env = env
+        pending = set(['userwebkit-0', 'foo-0'])
+        self.assertIsNone(app.on_env_failed(env, True, pending, 'oops'))
+        self.assertIs(app.env, env)
+        self.assertIn(None, pending)
+        self.assertEqual(app.ensure_databases._calls, [(env,)])
+        self.assertIsNone(app.on_env_failed(env, True, pending, 'oops'))
+        self.assertEqual(app.ensure_databases._calls, [(env,)])
+
+        # Failures for a replaced env are ignored:
+        self.assertIsNone(app.on_env_failed(random_env(), False, set(), 'x'))
+        self.assertIs(app.env, env)
+
+    def test_on_inspect(self):
+        class DummyInspector:
+            view = DummyCouchView()
+
+        # Only one inspector fits in the main window, reuse the open one:
+        app = userwebkit.BaseApp()
+        inspector = DummyInspector()
+        app.inspector = inspector
+        self.assertIs(app.on_inspect(), inspector.view)
+        self.assertIs(app.inspector, inspector)
+
+        # Destroying some other inspector doesn't forget the open one:
+        self.assertIsNone(app.on_inspector_destroy(DummyInspector()))
+        self.assertIs(app.inspector, inspector)
+        self.assertIsNone(app.on_inspector_destroy(inspector))
+        self.assertIsNone(app.inspector)
+
+    def test_run_in_background(self):
+        app = userwebkit.BaseApp()
+        self.assertIsNone(app._executor)
+        cb = DummyCallback()
+        task = app.run_in_background(cb, 'foo', callback=cb)
+        self.assertIsInstance(task, userwebkit.BackgroundTask)
+        self.assertIsNotNone(task.future)
+        self.assertIs(task.callback, cb)
+        self.assertIs(task.wait(5), True)
+        self.assertEqual(cb._calls, [('foo',)])
+        executor = app._executor
+        self.assertIsNotNone(executor)
+        app.run_in_background(cb, 'bar').wait(5)
+        self.assertIs(app._executor, executor)
+        self.assertEqual(cb._calls, [('foo',), ('bar',)])
+        executor.shutdown()
+
+    def test_iter_databases(self):
+        app = userwebkit.BaseApp()
+        self.assertEqual(list(app.iter_databases()), [('userwebkit-0', [])])
+        design = {'_id': '_design/foo', 'views': {}}
+        app.databases = {
+            'b-0': [design],
+            'a-0': [],
+            'userwebkit-0': [design],
+        }
+        self.assertEqual(list(app.iter_databases()), [
+            ('userwebkit-0', [design]),
+            ('a-0', []),
+            ('b-0', [design]),
+        ])
+
+    def test_ensure_databases(self):
+        app = userwebkit.BaseApp()
+        app.databases = {'foo-0': []}
+        app.dbs = {'userwebkit-0': DummyDatabase(), 'foo-0': DummyDatabase()}
+        app.run_in_background = DummyBackground()
+        env = random_env()
+        self.assertIsNone(app.ensure_databases(env))
+        calls = app.run_in_background._calls
+        self.assertEqual(len(calls), 2)
+        self.assertEqual([c[:2] for c in calls], [
+            (userwebkit.ensure_database, (app.dbs['userwebkit-0'], [])),
+            (userwebkit.ensure_database, (app.dbs['foo-0'], [])),
+        ])
+
+        # on_env_ready() is only called once all databases are ready:
+        ready = DummyCallback()
+        app.on_env_ready = ready
+        calls[1][2]([])
+        self.assertEqual(ready._calls, [])
+        calls[0][2](['_design/foo'])
+        self.assertEqual(ready._calls, [(env, None)])
+
     def test_get_page(self):
         inst = userwebkit.BaseApp()
         inst.options = DummyOptions()
@@ -525,8 +1932,21 @@ class TestBaseAppLive(TestCase):
         app.set_env(env)
         self.assertIs(app.env, env)
         self.assertIs(app.view._env, env)
+        self.assertIsInstance(app.ctx, PooledContext)
+        # Room for every worker and the changes feed, plus one spare:
+        self.assertEqual(app.ctx.pool.size, app.background_workers + 2)
         self.assertIsInstance(app.server, microfiber.Server)
+        self.assertIs(app.server.ctx, app.ctx)
         self.assertIsInstance(app.db, microfiber.Database)
+        self.assertIs(app.db.ctx, app.ctx)
+        self.assertEqual(list(app.dbs), ['userwebkit-0'])
+        self.assertIs(app.dbs['userwebkit-0'], app.db)
+
+        # set_env() doesn't block on CouchDB, BaseApp.on_env() ensures the db
+        # in the background:
+        with self.assertRaises(microfiber.NotFound):
+            app.db.get()
+        app.db.ensure()
         self.assertEqual(app.db.get()['db_name'], 'userwebkit-0')
         if app.intree:
             self.assertEqual(
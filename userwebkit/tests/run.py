@@ -38,6 +38,8 @@ import userwebkit
 
 pynames = (
     'userwebkit',
+    'userwebkit.view',
+    'userwebkit.pool',
     'userwebkit.tests',
 )
 
@@ -0,0 +1,381 @@
+# userwebkit: so WebKitGtk apps can to talk to a usercouch
+# Copyright (C) 2011 Novacut Inc
+# 
+# This file is part of `userwebkit`.
+# 
+# `userwebkit` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# `userwebkit` is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License along
+# with `userwebkit`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+WebKit views used by `userwebkit`.
+
+Importing this module imports Gtk and WebKit, so ``import userwebkit`` doesn't
+import it; use ``from userwebkit.view import CouchView`` instead.
+"""
+
+from os import path
+from urllib.parse import urlparse
+import logging
+import time
+
+from microfiber import _oauth_header, basic_auth_header
+from gi.repository import GLib, GObject, Gtk, WebKit
+
+from userwebkit import (
+    init, parse_uri, asset_filename, DmediaCache, ResourceTimings
+)
+
+
+log = logging.getLogger('userwebkit')
+
+
+class CouchView(WebKit.WebView):
+    __gsignals__ = {
+        'open': (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE,
+            [GObject.TYPE_PYOBJECT]
+        ),
+    }
+
+    def __init__(self, env=None, dmedia_resolver=None,
+            dmedia_resolve_many=None, background=None):
+        init()
+        super().__init__()
+        self._logging_enabled = False
+        self.timings = None
+        self._request_id = self.connect('resource-request-starting',
+            self._on_request
+        )
+        self.connect('navigation-policy-decision-requested',
+            self._on_nav_policy_decision
+        )
+        self.set_env(env)
+        self.set_assets(None, None)
+        self._dmedia_resolver = dmedia_resolver
+        if dmedia_resolver is None:
+            self._dmedia_cache = None
+        else:
+            self._dmedia_cache = DmediaCache(dmedia_resolver,
+                dmedia_resolve_many, background=background
+            )
+
+    def set_env(self, env):
+        self._env = env
+        if env is None:
+            self._u = None
+            self._base = None
+            self._prefix = None
+            self._oauth = None
+            self._authorization = None
+            return
+        self._u = urlparse(env['url'])
+        # Precompute the cheap prefix check used by _on_request():
+        self._base = ''.join([self._u.scheme, '://', self._u.netloc])
+        self._prefix = self._base + '/'
+        self._oauth = env.get('oauth')
+        authorization = env.get('authorization')
+        if authorization is None:
+            basic = env.get('basic')
+            if basic is not None:
+                authorization = basic_auth_header(basic)
+        self._authorization = authorization
+
+    def set_assets(self, path, directory):
+        """
+        Load static assets under HTTP *path* straight from *directory*.
+
+        Requests for JavaScript, CSS, images, etc. under *path* (for example
+        ``'/_apps/foo/'``) are redirected to the corresponding file in
+        *directory*, so they don't have to go through CouchDB.  HTML pages are
+        still loaded from CouchDB.  Call with ``None, None`` to turn this off.
+        """
+        self._assets_path = path
+        self._assets_dir = directory
+
+    def enable_logging(self):
+        if not self._logging_enabled:
+            self._logging_enabled = True
+            self.connect('console-message', self._on_console_message)
+
+    def _on_console_message(self, view, message, line, source_id):
+        log.debug('%s @%s: %s', source_id, line, message)
+
+    def enable_timings(self, size=500):
+        """
+        Record per-resource load timings in `CouchView.timings`.
+
+        When not enabled, `CouchView._on_request()` runs without any timing
+        overhead.
+        """
+        if self.timings is not None:
+            return
+        self.timings = ResourceTimings(size)
+        self.disconnect(self._request_id)
+        self._request_id = self.connect('resource-request-starting',
+            self._on_request_timed
+        )
+        self.connect('resource-load-finished', self._on_load_finished)
+        self.connect('resource-load-failed', self._on_load_failed)
+
+    def _on_request_timed(self, view, frame, resource, request, response):
+        uri = request.get_uri()
+        start = time.perf_counter()
+        self._on_request(view, frame, resource, request, response)
+        handler = time.perf_counter() - start
+        self.timings.start(resource, uri, request.get_uri(), handler)
+
+    def _on_load_finished(self, view, frame, resource):
+        self.timings.finish(resource)
+
+    def _on_load_failed(self, view, frame, resource, error):
+        self.timings.finish(resource, 'failed')
+
+    def prefetch_dmedia(self, ids, callback=None):
+        """
+        Resolve Dmedia *ids* in the background before the page requests them.
+
+        Does nothing when this view has no Dmedia resolver.
+        """
+        if self._dmedia_cache is None:
+            return
+        return self._dmedia_cache.prefetch(ids, callback)
+
+    def _on_request(self, view, frame, resource, request, response):
+        if self._env is None:
+            return
+        uri = request.get_uri()
+        if uri.startswith('dmedia:'):
+            if self._dmedia_cache is None:
+                request.set_uri('')
+            else:
+                _id = uri[7:]
+                (_id, status, filename) = self._dmedia_cache.resolve(_id)
+                if status == 0:
+                    request.set_uri('file://' + filename)
+                else:
+                    request.set_uri('')
+            return
+        if not (uri.startswith(self._prefix) or uri == self._base):
+            return
+        assets = self._assets_path
+        if assets is not None and uri.startswith(assets, len(self._base)):
+            relpath = uri[len(self._base) + len(assets):]
+            filename = asset_filename(self._assets_dir, relpath)
+            if filename is not None and path.isfile(filename):
+                request.set_uri('file://' + filename)
+                return
+        message = request.get_message()
+        if self._oauth:
+            (baseurl, query) = parse_uri(uri)
+            method = message.method
+            h = _oauth_header(self._oauth, method, baseurl, dict(query))
+            authorization = h['authorization']
+        else:
+            authorization = self._authorization
+        if authorization is not None:
+            message.request_headers.append('authorization', authorization)
+
+    def _on_nav_policy_decision(self, view, frame, request, nav, policy):
+        """
+        Handle user trying to Navigate away from current page.
+
+        Note that this will be called before `CouchView._on_resource_request()`.
+
+        The *policy* arg is a ``WebPolicyDecision`` instance.  To handle the
+        decision, call one of:
+
+            * ``WebPolicyDecision.ignore()``
+            * ``WebPolicyDecision.use()``
+            * ``WebPolicyDecision.download()``
+
+        And then return ``True``.
+
+        Otherwise, return ``False`` or ``None`` to have the WebKit default
+        behavior apply.
+        """
+        if self._env is None:
+            return
+        uri = request.get_uri()
+        u = urlparse(uri)
+        if u.netloc == self._u.netloc or u.scheme == 'file':
+            return False
+        if u.scheme in ('http', 'https'):
+            self.emit('open', uri)
+        policy.ignore()
+        return True
+
+
+class ViewPool:
+    """
+    Pool of `CouchView` instances built ahead of time, during idle periods.
+
+    `ViewPool.get()` hands out a ready-to-use view (building one right away
+    only when the pool is empty), then refills the pool at low priority.  If
+    provided, *setup* is called with each new view so it can connect signals
+    and set up settings before the view is handed out.
+
+    Views given back with `ViewPool.release()` are reused, even when *size*
+    is zero, in which case the pool never builds views ahead of time.
+    """
+
+    def __init__(self, size=1, setup=None, dmedia_resolver=None,
+            dmedia_resolve_many=None, background=None):
+        self.size = size
+        self.setup = setup
+        self._dmedia_args = (dmedia_resolver, dmedia_resolve_many)
+        self._background = background
+        self._env = None
+        self._assets = (None, None)
+        self._views = []
+        self._idle_id = None
+
+    def __len__(self):
+        return len(self._views)
+
+    def build(self):
+        view = CouchView(self._env, *self._dmedia_args,
+            background=self._background
+        )
+        view.set_assets(*self._assets)
+        if self.setup is not None:
+            self.setup(view)
+        return view
+
+    def get(self):
+        """
+        Return a ready-to-use `CouchView` set up with the current env.
+        """
+        view = (self._views.pop(0) if self._views else self.build())
+        self.fill()
+        return view
+
+    def release(self, view):
+        """
+        Reset *view* and keep it for reuse, or destroy it if the pool is full.
+
+        The caller should first remove *view* from its parent and disconnect
+        any signal handlers it connected itself.
+        """
+        view.stop_loading()
+        view.load_uri('about:blank')
+        if len(self._views) < max(self.size, 1):
+            view.set_env(self._env)
+            view.set_assets(*self._assets)
+            self._views.append(view)
+        else:
+            view.destroy()
+
+    def set_env(self, env):
+        self._env = env
+        for view in self._views:
+            view.set_env(env)
+
+    def set_assets(self, path, directory):
+        self._assets = (path, directory)
+        for view in self._views:
+            view.set_assets(path, directory)
+
+    def fill(self):
+        """
+        Build views at low priority until there are *size* of them ready.
+        """
+        if self._idle_id is None and len(self._views) < self.size:
+            self._idle_id = GLib.idle_add(self._on_idle,
+                priority=GLib.PRIORITY_LOW
+            )
+
+    def _on_idle(self):
+        self._views.append(self.build())
+        if len(self._views) < self.size:
+            return True
+        self._idle_id = None
+        return False
+
+
+class AppWindow(Gtk.Window):
+    """
+    An additional top-level window opened with `BaseApp.open_window()`.
+    """
+
+    def __init__(self, view, title, width, height):
+        super().__init__()
+        self.view = view
+        self.page = None
+        self.hub = None
+        self.set_default_size(width, height)
+        self.set_title(title)
+        self.scroll = Gtk.ScrolledWindow()
+        self.scroll.set_policy(
+            Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC
+        )
+        self.add(self.scroll)
+        self.scroll.add(view)
+
+
+class Inspector(Gtk.VBox):
+    def __init__(self, env, view=None, timings=None):
+        super().__init__()
+        self.timings = timings
+
+        hbox = Gtk.HBox()
+        self.pack_start(hbox, False, False, 0)
+
+        close = Gtk.Button(stock=Gtk.STOCK_CLOSE)
+        hbox.pack_start(close, False, False, 2)
+        close.connect('clicked', self.on_close)
+
+        self.reload = Gtk.Button('Reload')
+        hbox.pack_start(self.reload, False, False, 2)
+
+        self.futon = Gtk.Button('CouchDB Futon')
+        hbox.pack_start(self.futon, False, False, 2)
+
+        if timings is not None:
+            button = Gtk.Button('Resource Timings')
+            hbox.pack_start(button, False, False, 2)
+            button.connect('clicked', self.on_timings)
+            self.timings_view = Gtk.TextView()
+            self.timings_view.set_editable(False)
+            self.timings_scroll = Gtk.ScrolledWindow()
+            self.timings_scroll.set_policy(
+                Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC
+            )
+            self.timings_scroll.add(self.timings_view)
+            self.pack_start(self.timings_scroll, True, True, 0)
+            self.timings_scroll.set_no_show_all(True)
+
+        scroll = Gtk.ScrolledWindow()
+        self.pack_start(scroll, True, True, 0)
+        scroll.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
+
+        if view is None:
+            view = CouchView(env)
+        else:
+            view.set_env(env)
+        self.view = view
+        scroll.add(self.view)
+
+    def on_close(self, button):
+        # The view is WebKit's inspector frontend, so it's destroyed rather
+        # than reused, otherwise WebKit never learns the inspector closed:
+        self.destroy()
+
+    def on_timings(self, button):
+        if self.timings_scroll.get_visible():
+            self.timings_scroll.hide()
+            return
+        self.timings_view.get_buffer().set_text(self.timings.to_json())
+        self.timings_scroll.set_no_show_all(False)
+        self.timings_scroll.show_all()